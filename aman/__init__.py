@@ -1 +1,24 @@
-from .aman import main
+import importlib
+
+# the public names are imported on first use so the command line tool only
+# loads the modules it needs
+_EXPORTS = {
+    "main": ".aman",
+    "Config": ".config",
+    "Query": ".query",
+    "Session": ".session",
+    "SessionError": ".session",
+}
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if not module_name:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
@@ -1,18 +1,25 @@
 """aman - read Amiga autodocs as man pages"""
 
-import argparse
 import os
 import sys
 import logging
 
+# only modules needed by a plain lookup are imported here. the modules of
+# other modes are imported where they are used to keep startup fast.
 from .autodoc import AutoDocSet
-from .config import Config, ENV_DESC
+from .config import Config, ENV_DESC, BACKENDS, BACKEND_SQLITE
 from .format import Format
+from .index import PageIndices
 from .query import Query
+from .resultcache import ResultCache
+from .session import setup_doc_set
+from .stats import Stats, summarize_stats
 
 LOGGING_FORMAT = "%(message)s"
 AMAN_DEFAULT_CONFIG_FILE = "~/.aman/config.json"
 DESC = "read Amiga autodocs as man pages"
+SQL_STORE_FILE = "_store.sqlite"
+RESULT_CACHE_FILE = "_results.json.gz"
 
 
 def aman(
@@ -24,23 +31,53 @@ def aman(
     all_pages=False,
     list_books=False,
     list_pages=None,
+    list_sections=False,
+    list_protos=False,
+    stats=None,
 ):
-    cache_dir = config.get_cache_dir()
+    index_dir = config.get_index_dir()
 
     # setup doc set
     doc_set = AutoDocSet()
-    is_clean = doc_set.setup(
-        config.get_man_paths(), cache_dir, force_rebuild=force_rebuild, zip_cache=True
-    )
+    store = None
+    if config.get_backend() == BACKEND_SQLITE:
+        from .sqlstore import SqlStore
+
+        # sqlite backend: store replaces book caches and indices
+        doc_set.scan(config.get_man_paths())
+        store = SqlStore(os.path.join(index_dir, SQL_STORE_FILE))
+        store.open()
+        is_clean = store.setup(doc_set.get_docs(), force_rebuild=force_rebuild)
+        query.set_store(store)
+        resolver = store
+    else:
+        is_clean = setup_doc_set(doc_set, config, force_rebuild)
+        resolver = doc_set
+        # cache results of expensive searches
+        result_cache_size = config.get_result_cache_size()
+        if result_cache_size and query.mode in Query.CACHED_MODES:
+            result_cache = ResultCache(
+                os.path.join(index_dir, RESULT_CACHE_FILE), result_cache_size
+            )
+            result_cache.load(doc_set.get_generation())
+            query.set_result_cache(result_cache)
+    if stats:
+        stats.set("backend", config.get_backend())
+        stats.set("clean", is_clean)
 
     # list only books
     if list_books:
-        docs = doc_set.get_docs()
+        if stats:
+            stats.set("mode", "list_books")
+        if store:
+            books = store.get_books()
+        else:
+            books = []
+            for doc in doc_set.get_docs():
+                books.append((doc.get_name(), doc.get_book().get_topics()))
         lines = []
-        for doc in docs:
-            name = doc.get_name()
+        for name, topics in books:
             # add topics
-            topics = doc.get_book().get_topics()
             if len(topics) > 1 or topics[0] != name:
                 entry = f"{name:20} {', '.join(topics)}"
             else:
@@ -51,38 +88,94 @@ def aman(
 
     # list only pages
     if list_pages:
-        doc = doc_set.find_doc(list_pages)
-        if doc:
-            book = doc.get_book()
-            lines = book.get_toc()
+        if stats:
+            stats.set("mode", "list_pages")
+        lines = None
+        if store:
+            lines = store.get_toc(list_pages)
+        else:
+            doc = doc_set.find_doc(list_pages)
+            if doc:
+                lines = doc.get_book().get_toc()
+        if lines:
             fmt.format_lines(lines)
             return 0
         else:
             print(f"doc book '{list_pages}' not found!")
             return 1
 
+    # list only sections
+    if list_sections:
+        if stats:
+            stats.set("mode", "list_sections")
+        if store:
+            counts = store.get_section_counts()
+        else:
+            indices = PageIndices()
+            index = indices.add_section_index()
+            indices.setup(doc_set, index_dir, not is_clean, zip_index=True)
+            counts = []
+            for name, entry in sorted(index.get_entries().items()):
+                counts.append((name, entry.get_num_page_refs()))
+        lines = []
+        for name, num in counts:
+            lines.append(f"{name:20} {num}")
+        fmt.format_lines(lines)
+        return 0
+
+    # list prototypes as table
+    if list_protos:
+        if stats:
+            stats.set("mode", "list_protos")
+        if store:
+            print("prototypes are not supported by the sqlite backend!")
+            return 1
+        from .proto import ProtoIndex
+
+        proto_index = ProtoIndex()
+        proto_index.setup(doc_set.get_docs(), index_dir, not is_clean, zip_index=True)
+        rows = proto_index.get_rows(query.limit_books)
+        # keywords filter the table like a --proto query
+        if keywords:
+            rows = []
+            for key in keywords:
+                rows += proto_index.search_rows(
+                    key, query.ignore_case, query.limit_books
+                )
+        fmt.format_proto_rows(rows)
+        return 0
+
     # now at least one keyword is required
     if len(keywords) == 0:
         print("no search keyword given!")
         return 2
 
     # setup query
+    if store and not store.is_mode_supported(query.mode):
+        print(f"{query.get_mode_name()} search is not supported by the sqlite backend!")
+        return 1
     force_rebuild = not is_clean
-    query.setup(doc_set, cache_dir, force_rebuild, zip_index=True)
+    query.setup(doc_set, index_dir, force_rebuild, zip_index=True)
 
     # perform search for each keyword
+    sections = fmt.get_sections()
+    projected_pages = []
     for key in keywords:
         page_refs = query.search(key)
         if not page_refs:
             # no entry
             print(f"no entry found for '{key}'")
+        elif sections:
+            # only selected sections of all matches -> output them at once
+            pages = resolver.resolve_page_refs(page_refs, sections)
+            projected_pages.extend(pages)
         elif len(page_refs) == 1:
             # single match -> show page
-            page = doc_set.resolve_page_ref(page_refs[0])
+            page = resolver.resolve_page_ref(page_refs[0])
             fmt.format_page(page)
         else:
             # multiple matches -> list matches
-            pages = doc_set.resolve_page_refs(page_refs)
+            pages = resolver.resolve_page_refs(page_refs)
             if all_pages:
                 # show pages one by one
                 for page in pages:
@@ -90,11 +183,115 @@ def aman(
             else:
                 # show page list
                 fmt.format_page_list(pages)
+    if projected_pages:
+        fmt.format_projections(projected_pages)
+
+    if query.result_cache:
+        query.result_cache.save()
+
+    book_cache = doc_set.get_book_cache()
+    if book_cache:
+        logging.info("book cache: %s", book_cache.get_stats())
+
+    # record metrics
+    if stats:
+        stats.set("mode", query.get_mode_name())
+        stats.set("keywords", len(keywords))
+        stats.set("search_time", query.get_search_time())
+        if query.result_cache:
+            result_stats = query.result_cache.get_stats()
+            stats.set("result_hits", result_stats["hits"])
+            stats.set("result_lookups", result_stats["lookups"])
+        if book_cache:
+            book_stats = book_cache.get_stats()
+            stats.set("book_hits", book_stats["hits"])
+            stats.set("book_misses", book_stats["misses"])
+            stats.set("book_evictions", book_stats["evictions"])
+    return 0
+
+
+def build_bundle(config, bundle_dir):
+    """build all books and indices into a relocatable cache bundle"""
+    from .archive import open_archives
+    from .bundle import CacheBundle
+
+    if not os.path.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
 
+    # build all books and indices
+    doc_set = AutoDocSet()
+    doc_set.setup(
+        config.get_man_paths(), bundle_dir, force_rebuild=True, zip_cache=True
+    )
+    indices = PageIndices()
+    indices.add_title_index()
+    indices.add_topic_title_index()
+    indices.add_see_also_index()
+    indices.add_section_index()
+    indices.add_trigram_index()
+    indices.setup(doc_set, bundle_dir, force_rebuild=True, zip_index=True)
+
+    # write manifest with relative names only
+    bundle = CacheBundle(bundle_dir)
+    with open_archives():
+        for doc in doc_set.get_docs():
+            fingerprint = doc.get_fingerprint()
+            cache_file = os.path.basename(doc.get_cache_path())
+            bundle.add_book(doc.get_name(), fingerprint, cache_file)
+    for index in indices.get_indices():
+        bundle.add_index(os.path.basename(index.get_index_file()))
+    bundle.save()
+
+    print(f"built bundle with {bundle.get_num_books()} books in '{bundle_dir}'")
     return 0
 
 
+def export(config, out_dir, export_format, num_jobs=None, force_rebuild=False):
+    """export all pages of all books into out_dir"""
+    from .export import Export
+
+    doc_set = AutoDocSet()
+    setup_doc_set(doc_set, config, force_rebuild)
+    exp = Export(out_dir, export_format, num_jobs)
+    num = exp.export(doc_set)
+    print(f"exported {num} pages to '{out_dir}'")
+    return 0
+
+
+def lsp(config, force_rebuild=False):
+    """serve hover and completion of a language server on stdio"""
+    from .lsp import LspServer
+    from .session import Session
+
+    session = Session(config, force_rebuild)
+    server = LspServer(session)
+    return server.run()
+
+
+class PlainOptions:
+    """options of a plain 'aman KEYWORD...' call. all other options are unset"""
+
+    def __init__(self, keywords):
+        self.keywords = keywords
+        self.verbose = 0
+
+    def __getattr__(self, name):
+        return None
+
+
+def parse_plain_args(args):
+    """fast path: return PlainOptions if args are only keywords otherwise None"""
+    for arg in args:
+        if arg.startswith("-"):
+            return None
+    return PlainOptions(args)
+
+
 def parse_args():
+    import argparse
+
+    from .export import EXPORT_FORMATS, EXPORT_FORMAT_HTML
+
     # parse args
     parser = argparse.ArgumentParser(
         description=DESC,
@@ -115,6 +312,32 @@ def parse_args():
         "--list-pages",
         help="show available pages of a given book and quit",
     )
+    mode_grp.add_argument(
+        "--list-sections",
+        action="store_true",
+        help="show section names and their number of pages and quit",
+    )
+    mode_grp.add_argument(
+        "--list-protos",
+        action="store_true",
+        help="show table of prototypes and registers (matching keywords) and quit",
+    )
+
+    mode_grp.add_argument(
+        "--stats",
+        action="store_true",
+        help="show summary of usage statistics and cache files and quit",
+    )
+    mode_grp.add_argument(
+        "--lsp",
+        action="store_true",
+        help="run a language server on stdio for hover and completion",
+    )
+    mode_grp.add_argument(
+        "--export",
+        metavar="DIR",
+        help="render all pages of all books into files in DIR and quit",
+    )
 
     # search
     search_grp = parser.add_argument_group("search options")
@@ -147,6 +370,34 @@ def parse_args():
         action="store_true",
         help="full text search in page",
     )
+    search_grp.add_argument(
+        "-e",
+        "--regex",
+        action="store_true",
+        help="regular expression search in page",
+    )
+    search_grp.add_argument(
+        "-Q",
+        "--boolean",
+        action="store_true",
+        help='boolean query with AND, OR, NOT and "phrases" on page words',
+    )
+    search_grp.add_argument(
+        "--related",
+        action="store_true",
+        help="show pages most similar to the page with title keyword",
+    )
+    search_grp.add_argument(
+        "--proto",
+        action="store_true",
+        help="search prototypes with arg=, ret=, reg=, result= and name= terms",
+    )
+    search_grp.add_argument(
+        "--max-results",
+        type=int,
+        metavar="N",
+        help="stop searching after N matching pages",
+    )
     search_grp.add_argument(
         "-B",
         "--limit-books",
@@ -179,6 +430,23 @@ def parse_args():
     output_grp.add_argument(
         "-j", "--json", action="store_true", help="output in json format"
     )
+    output_grp.add_argument(
+        "--sections",
+        metavar="NAMES",
+        help="only show these sections (list separated by comma) of all matches",
+    )
+    output_grp.add_argument(
+        "--format",
+        choices=EXPORT_FORMATS,
+        default=EXPORT_FORMAT_HTML,
+        help="file format of --export",
+    )
+    output_grp.add_argument(
+        "--jobs",
+        type=int,
+        help="number of parallel worker processes of --export and full text "
+        "searches (default: number of cpus)",
+    )
 
     # config args
     config_grp = parser.add_argument_group("config options")
@@ -190,6 +458,21 @@ def parse_args():
     config_grp.add_argument(
         "--dump-config", action="store_true", help="dump current config into file"
     )
+    config_grp.add_argument(
+        "-D",
+        "--doc-set",
+        help="only use the autodocs of this doc set (NAME=PATH in man path)",
+    )
+    config_grp.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        help="storage backend for books and indices",
+    )
+    config_grp.add_argument(
+        "--build-bundle",
+        metavar="DIR",
+        help="build a relocatable cache bundle in DIR and quit",
+    )
     config_grp.add_argument(
         "-R",
         "--rebuild-cache",
@@ -201,7 +484,10 @@ def parse_args():
 
 
 def main():
-    opts = parse_args()
+    # skip the argument parser for plain lookups
+    opts = parse_plain_args(sys.argv[1:])
+    if not opts:
+        opts = parse_args()
 
     # setup logging
     if opts.verbose == 0:
@@ -224,12 +510,20 @@ def main():
     # apply options from command line
     if opts.man_path:
         man_paths = opts.man_path.split(os.pathsep)
-        config.set_man_paths(man_paths)
+        config.set_man_path(man_paths)
 
     # cache dir
     if opts.cache_dir:
         config.set_cache_dir(opts.cache_dir)
 
+    # doc set
+    if opts.doc_set:
+        config.set_doc_set(opts.doc_set)
+
+    # backend
+    if opts.backend:
+        config.set_backend(opts.backend)
+
     # pager setting
     if opts.no_pager:
         config.set_pager(None)
@@ -251,6 +545,31 @@ def main():
     if not config.finalize():
         sys.exit(1)
 
+    # show stats?
+    if opts.stats:
+        for line in summarize_stats(config.get_cache_dir()):
+            print(line)
+        sys.exit(0)
+
+    # build bundle?
+    if opts.build_bundle:
+        sys.exit(build_bundle(config, opts.build_bundle))
+
+    # language server?
+    if opts.lsp:
+        sys.exit(lsp(config, force_rebuild=opts.rebuild_cache))
+
+    # export?
+    if opts.export:
+        result = export(
+            config,
+            opts.export,
+            opts.format,
+            opts.jobs,
+            force_rebuild=opts.rebuild_cache,
+        )
+        sys.exit(result)
+
     # setup format
     fmt = Format()
     fmt.set_pager(config.get_pager())
@@ -258,6 +577,12 @@ def main():
         fmt.set_output_format(Format.OUTPUT_FORMAT_RAW)
     elif opts.json:
         fmt.set_output_format(Format.OUTPUT_FORMAT_JSON)
+    if opts.sections:
+        if opts.raw_page:
+            print("--sections can't be used with raw pages!")
+            sys.exit(2)
+        names = [x.strip().upper() for x in opts.sections.split(",")]
+        fmt.set_sections([x for x in names if x])
     # colorize?
     if opts.color:
         fmt.set_color(True)
@@ -279,10 +604,27 @@ def main():
         query.set_section(opts.full_section)
     elif opts.full_page:
         query.set_mode(Query.QUERY_MODE_FULL_PAGE)
+    elif opts.regex:
+        query.set_mode(Query.QUERY_MODE_REGEX)
+    elif opts.boolean:
+        query.set_mode(Query.QUERY_MODE_BOOLEAN)
+    elif opts.related:
+        query.set_mode(Query.QUERY_MODE_RELATED)
+    elif opts.proto:
+        query.set_mode(Query.QUERY_MODE_PROTO)
     if opts.limit_books:
         query.set_limit_books(opts.limit_books.split(":"))
     if opts.ignore_case:
         query.set_ignore_case(True)
+    if opts.max_results:
+        query.set_max_results(opts.max_results)
+    # full text scans run in parallel over all books
+    query.set_num_jobs(opts.jobs)
+
+    # record usage statistics
+    stats = None
+    if config.get_stats():
+        stats = Stats(config.get_cache_dir())
 
     # call main
     result = aman(
@@ -294,5 +636,10 @@ def main():
         all_pages=opts.all_pages,
         list_books=opts.list_books,
         list_pages=opts.list_pages,
+        list_sections=opts.list_sections,
+        list_protos=opts.list_protos,
+        stats=stats,
     )
+    if stats:
+        stats.save()
     sys.exit(result)
@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+ARCHIVE_EXTS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# archives kept open by open_archives()
+_local = threading.local()
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTS) and os.path.isfile(path)
+
+
+def is_zip(path):
+    return path.lower().endswith(".zip")
+
+
+def scan_archive(archive_path):
+    """return list of (member, mtime, size, signature) of all *.doc members.
+
+    The signature is the CRC for zip members and size+mtime for tar members.
+    """
+    import tarfile
+    import zipfile
+
+    result = []
+    if is_zip(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith(".doc") and not info.is_dir():
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    signature = f"{info.CRC:08x}"
+                    result.append((info.filename, mtime, info.file_size, signature))
+    else:
+        with tarfile.open(archive_path) as tf:
+            for info in tf.getmembers():
+                if info.name.endswith(".doc") and info.isfile():
+                    signature = f"{info.size:x}{int(info.mtime):08x}"
+                    result.append((info.name, info.mtime, info.size, signature))
+    logging.debug("archive '%s': %d members", archive_path, len(result))
+    return result
+
+
+def _open_archive(archive_path):
+    import tarfile
+    import zipfile
+
+    if is_zip(archive_path):
+        return zipfile.ZipFile(archive_path)
+    return tarfile.open(archive_path)
+
+
+def _open_archive_member(archive, member):
+    if hasattr(archive, "extractfile"):
+        return archive.extractfile(member)
+    return archive.open(member)
+
+
+@contextmanager
+def open_archives():
+    """keep the archives opened by open_member() of this thread open until
+    exit. tar members read in archive order are then found without scanning
+    or decompressing the archive again"""
+    if getattr(_local, "archives", None) is not None:
+        yield
+        return
+    _local.archives = {}
+    try:
+        yield
+    finally:
+        for archive in _local.archives.values():
+            archive.close()
+        _local.archives = None
+
+
+@contextmanager
+def open_member(archive_path, member):
+    """open a member of an archive as binary stream"""
+    archives = getattr(_local, "archives", None)
+    if archives is None:
+        with _open_archive(archive_path) as archive:
+            with _open_archive_member(archive, member) as fh:
+                yield fh
+        return
+    archive = archives.get(archive_path)
+    if not archive:
+        archive = _open_archive(archive_path)
+        archives[archive_path] = archive
+    with _open_archive_member(archive, member) as fh:
+        yield fh
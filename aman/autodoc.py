@@ -1,32 +1,166 @@
 import os
+import re
 import logging
 import time
-import json
-import gzip
 
+from .archive import open_member, open_archives
+from .bundle import get_fingerprint, get_stream_fingerprint, FingerprintCache
+from .cachefile import load_json, save_json, CacheLock
 from .parse import parse_autodoc
-from .scan import scan_autodocs, scan_cache
+from .scan import scan_autodocs, scan_cache, make_unique_names
 from .book import AutoDocBook
 from .index import PageIndex
+from .pagestore import PageStore, load_pack
 
 VERSION_TAG = "autobook_version"
-JSON_VERSION = 1
+JSON_VERSION = 3
+
+
+def get_cache_packs(cache_dir, zip):
+    """return names of the page packs used by the book caches in cache dir.
+    return None if a cache can't be read"""
+    ext = ".json.gz" if zip else ".json"
+    packs = set()
+    for file in os.listdir(cache_dir):
+        if file.startswith("_") or not file.endswith(ext):
+            continue
+        try:
+            data = load_json(os.path.join(cache_dir, file), zip)
+        except (OSError, ValueError, EOFError) as e:
+            logging.error("can't read cache '%s': %s", file, e)
+            return None
+        # caches of older versions use no packs
+        if data.get(VERSION_TAG) == JSON_VERSION:
+            packs.update(AutoDocBook.get_pack_names(data["book"]))
+    return packs
 
 
 class AutoDoc:
-    def __init__(self, name, doc_path, doc_mtime):
+    def __init__(self, name, doc_path, doc_mtime, doc_size=0):
         self.name = name
+        self.base_name = name
+        self.doc_set_name = None
         self.doc_path = doc_path
         self.doc_mtime = doc_mtime
+        self.doc_size = doc_size
         self.cache_path = None
         self.cache_mtime = 0
         self.cache_zip = False
+        self.cache_read_only = False
+        self.archive_path = None
+        self.archive_member = None
+        self.archive_signature = None
+        self.book = None
+        self.book_cache = None
+        self.page_store = None
+
+    def set_archive(self, archive_path, member, signature):
+        """the doc is a member of a zip/tar archive"""
+        self.archive_path = archive_path
+        self.archive_member = member
+        self.archive_signature = signature
+
+    def set_doc_set_name(self, doc_set_name):
+        """the doc was found in a man path of the named doc set"""
+        self.doc_set_name = doc_set_name
+
+    def get_doc_set_name(self):
+        return self.doc_set_name
+
+    def set_name(self, name):
+        """rename the doc, e.g. if another man path has a doc with same name"""
+        self.name = name
+
+    def get_base_name(self):
+        """name of the doc file without extension"""
+        return self.base_name
+
+    def _get_cache_base_name(self):
+        name = self.base_name
+        if self.doc_set_name:
+            name += "@" + self.doc_set_name
+        elif self.name != self.base_name:
+            name = self.name
+        return name
+
+    def get_cache_name(self):
+        """name of the cache file. archive members also add their signature"""
+        name = self._get_cache_base_name()
+        if self.archive_signature:
+            return f"{name}-{self.archive_signature}"
+        return name
+
+    def set_page_store(self, page_store):
+        """share a PageStore of the cache dir with other docs"""
+        self.page_store = page_store
+
+    def parse_doc(self, is_stored=None):
+        """parse the autodoc file or archive member and return book"""
+        if self.archive_path:
+            with open_member(self.archive_path, self.archive_member) as fh:
+                return parse_autodoc(self.doc_path, fh, is_stored)
+        return parse_autodoc(self.doc_path, is_stored=is_stored)
+
+    def get_fingerprint(self, fingerprint_cache=None):
+        """return content fingerprint of the autodoc. a FingerprintCache
+        avoids hashing unchanged files again"""
+        if fingerprint_cache:
+            if self.archive_path:
+                key = f"{self.archive_path}:{self.archive_member}"
+                path = self.archive_path
+            else:
+                key = path = self.doc_path
+            return fingerprint_cache.get(key, path, self.get_fingerprint)
+        if self.archive_path:
+            with open_member(self.archive_path, self.archive_member) as fh:
+                return get_stream_fingerprint(fh)
+        return get_fingerprint(self.doc_path)
+
+    def set_book_cache(self, book_cache):
+        """use a shared BookCache instead of keeping the book forever"""
+        self.book_cache = book_cache
         self.book = None
 
     def set_cache_file(self, cache_path, cache_mtime, cache_zip):
         self.cache_path = cache_path
         self.cache_mtime = cache_mtime
         self.cache_zip = cache_zip
+        self.cache_read_only = False
+
+    def set_bundle_cache_file(self, cache_path, cache_zip):
+        """use a read-only cache file of a bundle that matches the content"""
+        self.cache_path = cache_path
+        self.cache_mtime = os.stat(cache_path).st_mtime
+        self.cache_zip = cache_zip
+        self.cache_read_only = True
+
+    def get_worker_info(self):
+        """return picklable tuple to load the book in a worker process"""
+        return (
+            self.name,
+            self.doc_path,
+            self.doc_mtime,
+            self.cache_path,
+            self.cache_zip,
+            self.cache_read_only,
+            self.archive_path,
+            self.archive_member,
+            self.archive_signature,
+        )
+
+    @staticmethod
+    def from_worker_info(info):
+        """return doc of a worker info tuple"""
+        name, doc_path, doc_mtime, cache_path, cache_zip, read_only = info[:6]
+        doc = AutoDoc(name, doc_path, doc_mtime)
+        if read_only:
+            doc.set_bundle_cache_file(cache_path, cache_zip)
+        else:
+            doc.set_cache_file(cache_path, 0, cache_zip)
+        archive_path, member, signature = info[6:]
+        if archive_path:
+            doc.set_archive(archive_path, member, signature)
+        return doc
 
     def get_name(self):
         return self.name
@@ -34,20 +168,56 @@ class AutoDoc:
     def get_doc_path(self):
         return self.doc_path
 
+    def get_doc_mtime(self):
+        return self.doc_mtime
+
+    def get_doc_size(self):
+        """size of the autodoc text in bytes"""
+        return self.doc_size
+
     def get_cache_path(self):
         return self.cache_path
 
+    def is_cache_zip(self):
+        return self.cache_zip
+
+    def get_cache_mtime(self):
+        return self.cache_mtime
+
     def is_cache_valid(self):
+        if self.cache_read_only:
+            return True
         return self.cache_mtime > self.doc_mtime
 
+    def is_cache_read_only(self):
+        return self.cache_read_only
+
     def get_book(self):
+        # bounded book cache?
+        if self.book_cache:
+            book = self.book_cache.get(self.cache_path)
+            if not book:
+                book = self._load_cache()
+                if book:
+                    self.book_cache.put(self.cache_path, book)
+            return book
         # need to load cache?
         if not self.book:
-            ok = self._load_cache()
-            if not ok:
-                logging.error("can't load cache '%s'", self.cache_path)
+            self.book = self._load_cache()
         return self.book
 
+    def _store_book(self, book):
+        if self.book_cache:
+            self.book_cache.put(self.cache_path, book)
+        else:
+            self.book = book
+
+    def _drop_book(self):
+        """forget the loaded book, e.g. the old one after a rebuild"""
+        if self.book_cache:
+            self.book_cache.remove(self.cache_path)
+        self.book = None
+
     def __repr__(self):
         return f"AutoDoc({self.doc_path}, {self.name}, {self.mtime})"
 
@@ -60,47 +230,103 @@ class AutoDoc:
         else:
             return True
 
+    def _get_page_store(self):
+        if not self.page_store:
+            cache_dir = os.path.dirname(self.cache_path)
+            self.page_store = PageStore(cache_dir, self.cache_zip)
+        return self.page_store
+
     def _build_cache(self):
         logging.info("parsing autodoc from '%s'", self.doc_path)
         start = time.monotonic()
 
-        self.book = parse_autodoc(self.doc_path)
+        # only parse pages not found in the page store
+        page_store = self._get_page_store()
+        book = self.parse_doc(page_store.find_pack)
         end = time.monotonic()
-        num = len(self.book.get_toc())
-        self._save_cache()
 
-        logging.info("stored %s entries in %.6f", num, end - start)
+        # store new pages in a pack
+        page_packs = {}
+        new_pages = {}
+        for title, page in book.get_pages().items():
+            page_hash = page.get_hash()
+            pack = page_store.find_pack(page_hash)
+            if pack:
+                page_packs[page_hash] = pack
+            else:
+                data = page.to_cache_json()
+                data["title"] = title
+                new_pages[page_hash] = data
+        if new_pages:
+            pack = page_store.add_pages(new_pages)
+            for page_hash in new_pages:
+                page_packs[page_hash] = pack
+        self._save_cache(book, page_packs)
 
-    def _save_cache(self):
-        data = {VERSION_TAG: JSON_VERSION, "book": self.book.to_json()}
-        if self.cache_zip:
-            with gzip.open(self.cache_path, "wt") as fh:
-                json.dump(data, fh)
+        # stored pages are not parsed. load them on demand
+        num = len(book.get_toc())
+        if len(new_pages) == num:
+            self._store_book(book)
         else:
-            with open(self.cache_path, "w") as fh:
-                json.dump(data, fh)
+            self._drop_book()
+
+        logging.info(
+            "stored %s entries (%s new) in %.6f", num, len(new_pages), end - start
+        )
+
+    def _save_cache(self, book, page_packs):
+        data = {VERSION_TAG: JSON_VERSION, "book": book.to_json(page_packs)}
+        save_json(self.cache_path, data, self.cache_zip)
+        self.cache_mtime = os.stat(self.cache_path).st_mtime
+        if self.archive_signature:
+            self._remove_stale_caches()
+
+    def _remove_stale_caches(self):
+        """remove caches of other versions of the archive member"""
+        cache_dir, cache_file = os.path.split(self.cache_path)
+        name = re.escape(self._get_cache_base_name())
+        stale_re = re.compile(name + r"-[0-9a-f]{8,}\.json(\.gz)?")
+        for file in os.listdir(cache_dir):
+            if file != cache_file and stale_re.fullmatch(file):
+                logging.info("removing stale cache '%s'", file)
+                os.remove(os.path.join(cache_dir, file))
 
     def _load_cache(self):
+        """load book from cache file. return book or None"""
         start = time.monotonic()
-        if self.cache_zip:
-            with gzip.open(self.cache_path, "rt") as fh:
-                data = json.load(fh)
-        else:
-            with open(self.cache_path) as fh:
-                data = json.load(fh)
+        data = load_json(self.cache_path, self.cache_zip)
         # check version
-        if VERSION_TAG not in data:
-            return False
-        if data[VERSION_TAG] != JSON_VERSION:
-            return False
+        if VERSION_TAG not in data or data[VERSION_TAG] != JSON_VERSION:
+            logging.error("can't load cache '%s': wrong version", self.cache_path)
+            return self._recover_book()
+        # load the page packs next to the cache file
+        book = AutoDocBook(self.doc_path)
+        cache_dir = os.path.dirname(self.cache_path)
+        packs = {}
+        for pack in book.get_pack_names(data["book"]):
+            packs[pack] = load_pack(cache_dir, pack, self.cache_zip)
         # read data
-        self.book = AutoDocBook(self.doc_path)
-        ok = self.book.from_json(data["book"])
+        ok = book.from_json(data["book"], packs)
         end = time.monotonic()
         logging.info(
-            "load cache from '%s' in %.6f ok=%s", self.cache_path, end - start, ok
+            "load cache from '%s' with %d packs in %.6f ok=%s",
+            self.cache_path,
+            len(packs),
+            end - start,
+            ok,
         )
-        return ok
+        if not ok:
+            logging.error("can't load cache '%s'", self.cache_path)
+            return self._recover_book()
+        return book
+
+    def _recover_book(self):
+        """parse the doc if its cache is broken and let the next run rebuild it"""
+        if not self.cache_read_only and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        self.cache_mtime = 0
+        logging.warning("parsing '%s' without cache", self.doc_path)
+        return self.parse_doc()
 
 
 class AutoDocSet:
@@ -109,7 +335,31 @@ class AutoDocSet:
         self.index = None
         self.short_index = None
         self.cache_dir = None
+        self.zip_cache = False
         self.name_doc_map = {}
+        self.book_cache = None
+        self.bundles = []
+        self.index_bundle = None
+        self.page_store = None
+
+    def add_bundle(self, bundle):
+        """add a read-only CacheBundle layer. set before setup()"""
+        self.bundles.append(bundle)
+
+    def get_index_bundle(self):
+        """return the bundle holding all books of the set or None"""
+        return self.index_bundle
+
+    def set_book_cache(self, book_cache):
+        """limit the loaded books with a BookCache. set before setup()"""
+        self.book_cache = book_cache
+
+    def get_book_cache(self):
+        return self.book_cache
+
+    def get_page_store(self):
+        """PageStore of the cache dir used to build book caches"""
+        return self.page_store
 
     def add_doc(self, doc):
         self.docs.append(doc)
@@ -117,29 +367,88 @@ class AutoDocSet:
     def get_docs(self):
         return self.docs
 
+    def get_cache_dir(self):
+        return self.cache_dir
+
+    def is_zip_cache(self):
+        return self.zip_cache
+
+    def get_generation(self):
+        """return a stamp that changes if any book cache is rebuilt"""
+        import hashlib
+
+        h = hashlib.sha1()
+        for doc in sorted(self.docs, key=lambda x: x.get_name()):
+            h.update(
+                f"{doc.get_name()}:{doc.get_cache_path()}:{doc.get_cache_mtime()};".encode()
+            )
+        return h.hexdigest()
+
+    def copy_with_docs(self, docs):
+        """return a new set with the given docs sharing our caches, e.g.
+        after a refresh. its indices are always kept in the cache dir"""
+        doc_set = AutoDocSet()
+        doc_set.cache_dir = self.cache_dir
+        doc_set.zip_cache = self.zip_cache
+        doc_set.book_cache = self.book_cache
+        doc_set.bundles = self.bundles
+        doc_set.page_store = self.page_store
+        for doc in docs:
+            doc_set.add_doc(doc)
+            doc_set.name_doc_map[doc.get_name()] = doc
+        return doc_set
+
     def find_doc(self, name):
         for doc in self.docs:
             if doc.get_name() == name:
                 return doc
 
+    def scan(self, doc_paths):
+        """only scan for autodocs without setting up caches"""
+        for path in doc_paths:
+            self.docs += scan_autodocs(path, AutoDoc)
+        make_unique_names(self.docs)
+        for doc in self.docs:
+            self.name_doc_map[doc.get_name()] = doc
+
     def setup(self, doc_paths, cache_dir, force_rebuild=False, zip_cache=False):
         start = time.monotonic()
 
         # scan for autodocs
-        for path in doc_paths:
-            self.docs += scan_autodocs(path, AutoDoc)
+        self.scan(doc_paths)
+        if self.book_cache:
+            for doc in self.docs:
+                doc.set_book_cache(self.book_cache)
 
-        # scan the cache
+        # take books from bundles. the others use the cache dir
         self.cache_dir = cache_dir
-        scan_cache(cache_dir, self.docs, zip=zip_cache)
-
-        # setup cache
-        all_valid = True
+        self.zip_cache = zip_cache
+        self.page_store = PageStore(cache_dir, zip_cache)
         for doc in self.docs:
-            was_valid = doc.setup_cache(force_rebuild)
-            all_valid = all_valid and was_valid
-            # store mapping: name -> doc
-            self.name_doc_map[doc.get_name()] = doc
+            doc.set_page_store(self.page_store)
+        cache_docs = self.docs
+        if self.bundles and not force_rebuild:
+            cache_docs = self._scan_bundles(zip_cache)
+        scan_cache(cache_dir, cache_docs, zip=zip_cache)
+
+        # rebuild caches while holding the lock. other processes wait and
+        # then find the caches valid on the rescan
+        all_valid = all(map(lambda x: x.is_cache_valid(), self.docs))
+        if force_rebuild or not all_valid:
+            with CacheLock(cache_dir):
+                if force_rebuild:
+                    self.page_store.reset()
+                else:
+                    scan_cache(cache_dir, cache_docs, zip=zip_cache)
+                all_valid = True
+                # docs are in archive order, so archives are read only once
+                with open_archives():
+                    for doc in self.docs:
+                        was_valid = doc.setup_cache(force_rebuild)
+                        all_valid = all_valid and was_valid
+                self.page_store.flush()
+                if not all_valid:
+                    self.remove_unused_packs()
 
         end = time.monotonic()
         num_books = len(self.docs)
@@ -152,7 +461,46 @@ class AutoDocSet:
 
         return all_valid
 
-    def resolve_page_ref(self, page_ref):
+    def remove_unused_packs(self):
+        """remove packs of the page store no book cache refers to anymore.
+        call with the cache lock held"""
+        start = time.monotonic()
+        packs = get_cache_packs(self.cache_dir, self.zip_cache)
+        if packs is None:
+            return
+        num = self.page_store.remove_unused_packs(packs)
+        end = time.monotonic()
+        logging.info("removed %d unused page packs in %.6f", num, end - start)
+
+    def _scan_bundles(self, zip_cache):
+        """assign bundle caches to docs. return docs not found in bundles"""
+        remaining = []
+        used_bundles = set()
+        fingerprint_cache = FingerprintCache(self.cache_dir, zip_cache)
+        fingerprint_cache.load()
+        with open_archives():
+            for doc in self.docs:
+                fingerprint = doc.get_fingerprint(fingerprint_cache)
+                for bundle in self.bundles:
+                    cache_path = bundle.find_book(doc.get_name(), fingerprint)
+                    if cache_path:
+                        doc.set_bundle_cache_file(cache_path, zip_cache)
+                        used_bundles.add(bundle)
+                        logging.info("bundle cache '%s'", cache_path)
+                        break
+                else:
+                    remaining.append(doc)
+        fingerprint_cache.save()
+        # indices of a bundle are only valid if it holds exactly our books
+        if not remaining and len(used_bundles) == 1:
+            bundle = used_bundles.pop()
+            if bundle.get_num_books() == len(self.docs):
+                self.index_bundle = bundle
+        return remaining
+
+    def resolve_page_ref(self, page_ref, sections=None):
+        """return page of ref. its sections are materialized on demand, so
+        selecting sections only matters for other resolvers"""
         doc_name = page_ref.get_doc_name()
         doc = self.name_doc_map[doc_name]
         book = doc.get_book()
@@ -160,7 +508,7 @@ class AutoDocSet:
         logging.info("resolved page: %s -> %s %s", page_ref, book, page)
         return page
 
-    def resolve_page_refs(self, page_refs):
+    def resolve_page_refs(self, page_refs, sections=None):
         pages = []
         for page_ref in page_refs:
             page = self.resolve_page_ref(page_ref)
@@ -1,3 +1,6 @@
+from .pagestore import get_page_hash
+
+
 class AutoDocBook:
     def __init__(self, file_name):
         self.file_name = file_name
@@ -30,13 +33,25 @@ class AutoDocBook:
     def get_pages(self):
         return self.pages
 
-    def to_json(self):
+    def estimate_size(self):
+        """rough estimate of the memory used by the text of all pages"""
+        return sum(map(lambda x: x.estimate_size(), self.pages.values()))
+
+    @staticmethod
+    def get_pack_names(data):
+        """return names of the page packs used by the book json"""
+        return set(map(lambda x: x[1], data["pages"].values()))
+
+    def to_json(self, page_packs):
+        """book json refers to the pack of each page by page hash"""
         pages = {}
         for name, page in self.pages.items():
-            pages[name] = page.to_json()
+            page_hash = page.get_hash()
+            pages[name] = (page_hash, page_packs[page_hash])
         return {"toc": self.toc, "pages": pages, "topics": self.topics}
 
-    def from_json(self, data):
+    def from_json(self, data, packs):
+        """build pages from book json and the loaded packs"""
         if "toc" not in data:
             return False
         if "pages" not in data:
@@ -46,22 +61,51 @@ class AutoDocBook:
         self.pages = {}
         page_data = data["pages"]
         for title in self.toc:
+            page_hash, pack = page_data[title]
+            pack_pages = packs.get(pack)
+            if not pack_pages or page_hash not in pack_pages:
+                return False
             page = AutoDocPage(title)
             page.set_book(self)
-            ok = page.from_json(page_data[title])
+            ok = page.from_cache_json(pack_pages[page_hash])
             if not ok:
                 return False
+            page.set_hash(page_hash)
             self.pages[title] = page
         return True
 
 
+def get_span_lines(raw_lines, span):
+    """materialize the cleaned, deindented lines of a section span"""
+    start, end, indent = span
+    result = []
+    for line in raw_lines[start:end]:
+        line = line.replace("\t", "    ")
+        # empty or only spaces
+        if not line.strip(" "):
+            line = ""
+        else:
+            line = line[indent:]
+        result.append(line)
+    return result
+
+
 class AutoDocPage:
+    """a page of a book.
+
+    The text is only stored once in the raw page. Sections are kept as
+    spans (start line, end line, indent) into its lines and are materialized
+    on demand. Sections can also be added as lines directly.
+    """
+
     def __init__(self, title):
         self.title = title
         self.raw_page = None
         self.toc = []
+        self.spans = {}
         self.sections = {}
         self.book = None
+        self.page_hash = None
 
     def __repr__(self):
         return f"AutoDocPage({self.title},#toc={len(self.toc)})"
@@ -70,9 +114,10 @@ class AutoDocPage:
         lines = []
         lines.append(self.title)
         lines.append("")
+        sections = self.get_sections()
         for section in self.toc:
             lines.append(section)
-            for line in self.sections[section]:
+            for line in sections[section]:
                 lines.append("\t" + line)
             lines.append("")
         return lines
@@ -85,6 +130,11 @@ class AutoDocPage:
         self.toc.append(title)
         self.sections[title] = lines
 
+    def add_section_span(self, title, start, end, indent):
+        """add section as lines start..end of raw page without indent"""
+        self.toc.append(title)
+        self.spans[title] = (start, end, indent)
+
     def set_book(self, book):
         self.book = book
 
@@ -103,29 +153,85 @@ class AutoDocPage:
     def get_toc(self):
         return self.toc
 
+    def set_hash(self, page_hash):
+        self.page_hash = page_hash
+
+    def get_hash(self):
+        """content address of the page"""
+        if not self.page_hash:
+            self.page_hash = get_page_hash(self.title, self.raw_page)
+        return self.page_hash
+
     def get_section(self, title):
-        return self.sections[title]
+        lines = self.sections.get(title)
+        if lines is not None:
+            return lines
+        span = self.spans[title]
+        return get_span_lines(self.raw_page.split("\n"), span)
 
     def find_section(self, title):
-        return self.sections.get(title)
+        if title in self.sections or title in self.spans:
+            return self.get_section(title)
+        return None
 
     def get_sections(self):
-        return self.sections
+        """return dict of all sections with their lines"""
+        sections = dict(self.sections)
+        if self.spans:
+            raw_lines = self.raw_page.split("\n")
+            for title, span in self.spans.items():
+                sections[title] = get_span_lines(raw_lines, span)
+        return sections
+
+    def get_projection(self, names):
+        """return dict of the given section names found in page -> lines.
+        only these sections are materialized"""
+        result = {}
+        raw_lines = None
+        for name in names:
+            lines = self.sections.get(name)
+            if lines is None:
+                span = self.spans.get(name)
+                if span is None:
+                    continue
+                if raw_lines is None:
+                    raw_lines = self.raw_page.split("\n")
+                lines = get_span_lines(raw_lines, span)
+            result[name] = lines
+        return result
+
+    def estimate_size(self):
+        """rough estimate of the memory used by the text of the page"""
+        size = len(self.raw_page) if self.raw_page else 0
+        for lines in self.sections.values():
+            size += sum(map(len, lines))
+        return size
 
     def to_json(self):
-        return {"toc": self.toc, "sections": self.sections, "raw_page": self.raw_page}
-
-    def from_json(self, data):
+        return {
+            "toc": self.toc,
+            "sections": self.get_sections(),
+            "raw_page": self.raw_page,
+        }
+
+    def to_cache_json(self):
+        """compact form for caches: spans into the raw page only"""
+        data = {"toc": self.toc, "spans": self.spans, "raw_page": self.raw_page}
+        if self.sections:
+            data["sections"] = self.sections
+        return data
+
+    def from_cache_json(self, data):
         if "toc" not in data:
             return False
-        if "sections" not in data:
+        if "spans" not in data:
             return False
         if "raw_page" not in data:
             return False
         self.toc = data["toc"]
         self.raw_page = data["raw_page"]
-        self.sections = {}
-        sections_data = data["sections"]
-        for title in self.toc:
-            self.sections[title] = sections_data[title]
+        self.spans = {}
+        for title, span in data["spans"].items():
+            self.spans[title] = tuple(span)
+        self.sections = data.get("sections", {})
         return True
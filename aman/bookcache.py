@@ -0,0 +1,90 @@
+import logging
+import threading
+from collections import OrderedDict
+
+
+class BookCache:
+    """keep loaded books in memory with a budget and evict least recently used.
+
+    The budget is given as maximum number of books and/or the maximum of
+    estimated bytes of all books. A value of 0 disables the limit.
+    """
+
+    def __init__(self, max_books=0, max_bytes=0):
+        self.max_books = max_books
+        self.max_bytes = max_bytes
+        self.books = OrderedDict()
+        self.num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"BookCache(#books={len(self.books)}/{self.max_books},"
+            f"bytes={self.num_bytes}/{self.max_bytes})"
+        )
+
+    def get(self, key):
+        """return cached book or None"""
+        with self.lock:
+            entry = self.books.get(key)
+            if entry is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+            self.books.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, book):
+        """add a book and evict old ones if budget is exceeded"""
+        size = book.estimate_size() if self.max_bytes else 0
+        with self.lock:
+            if key in self.books:
+                self._remove(key)
+            self.books[key] = (book, size)
+            self.num_bytes += size
+            # evict but always keep the new book
+            while len(self.books) > 1 and self._is_over_budget():
+                old_key = next(iter(self.books))
+                self._remove(old_key)
+                self.num_evictions += 1
+                logging.info("book cache: evicted '%s'", old_key)
+
+    def remove(self, key):
+        """drop a book, e.g. if its cache was rebuilt"""
+        with self.lock:
+            if key in self.books:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.books.clear()
+            self.num_bytes = 0
+
+    def get_num_books(self):
+        return len(self.books)
+
+    def get_num_bytes(self):
+        return self.num_bytes
+
+    def get_stats(self):
+        return {
+            "books": len(self.books),
+            "bytes": self.num_bytes,
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "evictions": self.num_evictions,
+        }
+
+    def _remove(self, key):
+        _, size = self.books.pop(key)
+        self.num_bytes -= size
+
+    def _is_over_budget(self):
+        if self.max_books and len(self.books) > self.max_books:
+            return True
+        if self.max_bytes and self.num_bytes > self.max_bytes:
+            return True
+        return False
@@ -0,0 +1,132 @@
+import os
+import logging
+
+from .cachefile import load_json, save_json
+
+MANIFEST_NAME = "_manifest.json"
+VERSION_TAG = "bundle_version"
+JSON_VERSION = 1
+FINGERPRINTS_FILE = "_fingerprints.json"
+FINGERPRINTS_VERSION_TAG = "fingerprints_version"
+FINGERPRINTS_JSON_VERSION = 1
+
+
+def get_fingerprint(path):
+    """return content fingerprint of a file"""
+    with open(path, "rb") as fh:
+        return get_stream_fingerprint(fh)
+
+
+def get_stream_fingerprint(fh):
+    """return content fingerprint of a binary stream"""
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(fh.read())
+    return h.hexdigest()
+
+
+class FingerprintCache:
+    """keep fingerprints of autodocs in the cache dir.
+
+    An entry is reused while the file has the same size and mtime, so
+    only new or changed autodocs are hashed when bundles are matched.
+    """
+
+    def __init__(self, cache_dir, zip=False):
+        index_name = FINGERPRINTS_FILE
+        if zip:
+            index_name += ".gz"
+        self.cache_file = os.path.join(cache_dir, index_name)
+        self.zip = zip
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return False
+        data = load_json(self.cache_file, self.zip)
+        if data.get(FINGERPRINTS_VERSION_TAG) != FINGERPRINTS_JSON_VERSION:
+            return False
+        self.entries = data["entries"]
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # forget files that are gone
+        entries = {}
+        for key, entry in self.entries.items():
+            if os.path.exists(entry[0]):
+                entries[key] = entry
+        data = {FINGERPRINTS_VERSION_TAG: FINGERPRINTS_JSON_VERSION, "entries": entries}
+        save_json(self.cache_file, data, self.zip)
+        self.dirty = False
+
+    def get(self, key, path, fingerprint_func):
+        """return fingerprint of key stored in file path. if the file
+        changed then fingerprint_func() computes a new one"""
+        st = os.stat(path)
+        entry = self.entries.get(key)
+        if entry and entry[1:3] == [st.st_size, st.st_mtime]:
+            return entry[3]
+        fingerprint = fingerprint_func()
+        self.entries[key] = [path, st.st_size, st.st_mtime, fingerprint]
+        self.dirty = True
+        return fingerprint
+
+
+class CacheBundle:
+    """a read-only and relocatable cache dir with books, indices and manifest.
+
+    Books are matched by the fingerprint of their autodoc file and not by
+    path or mtime, so a bundle can be built once and copied anywhere.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        self.books = {}
+        self.indices = []
+
+    def __repr__(self):
+        return f"CacheBundle({self.bundle_dir},#books={len(self.books)})"
+
+    def get_dir(self):
+        return self.bundle_dir
+
+    def load(self):
+        manifest = os.path.join(self.bundle_dir, MANIFEST_NAME)
+        if not os.path.exists(manifest):
+            logging.info("bundle: no manifest in '%s'", self.bundle_dir)
+            return False
+        data = load_json(manifest, False)
+        if VERSION_TAG not in data or data[VERSION_TAG] != JSON_VERSION:
+            logging.error("bundle: wrong version in '%s'", manifest)
+            return False
+        self.books = data["books"]
+        self.indices = data["indices"]
+        logging.info("bundle: loaded %s", self)
+        return True
+
+    def save(self):
+        manifest = os.path.join(self.bundle_dir, MANIFEST_NAME)
+        data = {VERSION_TAG: JSON_VERSION, "books": self.books, "indices": self.indices}
+        save_json(manifest, data, False)
+
+    def add_book(self, name, fingerprint, cache_file):
+        self.books[name] = {"fingerprint": fingerprint, "cache_file": cache_file}
+
+    def add_index(self, index_file):
+        self.indices.append(index_file)
+
+    def find_book(self, name, fingerprint):
+        """return path of cache file if book with same content is in bundle"""
+        book = self.books.get(name)
+        if book and book["fingerprint"] == fingerprint:
+            return os.path.join(self.bundle_dir, book["cache_file"])
+
+    def has_index(self, index_file):
+        return index_file in self.indices
+
+    def get_num_books(self):
+        return len(self.books)
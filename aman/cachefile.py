@@ -0,0 +1,81 @@
+import os
+import json
+import gzip
+import time
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_FILE_NAME = "_lock"
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# mode of new cache files. mkstemp only creates files readable by the owner
+FILE_MODE = 0o666 & ~_get_umask()
+
+
+def load_json(path, zip):
+    """load json data from a (gzipped) file"""
+    if zip:
+        with gzip.open(path, "rt") as fh:
+            return json.load(fh)
+    else:
+        with open(path) as fh:
+            return json.load(fh)
+
+
+def save_json(path, data, zip):
+    """save json data to a (gzipped) file.
+
+    The data is written to a temp file first and then renamed, so readers
+    never see a partially written file.
+    """
+    import tempfile
+
+    dir_name, base_name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + base_name, dir=dir_name)
+    try:
+        if zip:
+            with os.fdopen(fd, "wb") as raw_fh:
+                with gzip.open(raw_fh, "wt") as fh:
+                    json.dump(data, fh)
+        else:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(data, fh)
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class CacheLock:
+    """advisory lock on a cache directory to serialize cache rebuilds"""
+
+    def __init__(self, cache_dir):
+        self.lock_path = os.path.join(cache_dir, LOCK_FILE_NAME)
+        self.fh = None
+
+    def __enter__(self):
+        start = time.monotonic()
+        self.fh = open(self.lock_path, "a")
+        if fcntl:
+            fcntl.flock(self.fh, fcntl.LOCK_EX)
+        end = time.monotonic()
+        logging.info("locked '%s' in %.6f", self.lock_path, end - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.fh.close()
+        self.fh = None
+        logging.info("unlocked '%s'", self.lock_path)
@@ -2,15 +2,30 @@ import os
 import json
 import logging
 
+from .scan import split_man_path
+
 JSON_VERSION = 1
 VERSION_TAG = "aman_config"
 MAN_PATHS_TAG = "man_paths"
 CACHE_DIR_TAG = "cache_dir"
+CACHE_LAYERS_TAG = "cache_layers"
 PAGER_TAG = "pager"
+BACKEND_TAG = "backend"
+MAX_BOOKS_TAG = "max_books"
+MAX_BOOK_BYTES_TAG = "max_book_bytes"
+RESULT_CACHE_SIZE_TAG = "result_cache_size"
+STATS_TAG = "stats"
+DOC_SET_TAG = "doc_set"
 
 AMAN_DEFAULT_CACHE_DIR = "~/.aman/cache"
+
+BACKEND_JSON = "json"
+BACKEND_SQLITE = "sqlite"
+BACKENDS = (BACKEND_JSON, BACKEND_SQLITE)
 AMAN_ENV_PATH_VAR = "AMANPATH"
 AMAN_ENV_CACHE_VAR = "AMANCACHE"
+AMAN_ENV_LAYERS_VAR = "AMANLAYERS"
+AMAN_ENV_DOC_SET_VAR = "AMANDOCSET"
 AMAN_ENV_MANPAGER_VAR = "MANPAGER"
 AMAN_ENV_PAGER_VAR = "PAGER"
 
@@ -19,6 +34,8 @@ environment variables:
 
 AMANPATH   list of autodoc directories, separated by '{os.pathsep}'
 AMANCACHE  directory of cache files ({AMAN_DEFAULT_CACHE_DIR})
+AMANLAYERS list of read-only cache bundle directories, separated by '{os.pathsep}'
+AMANDOCSET name of the doc set to use (name=path entries in AMANPATH)
 MANPAGER   or
 PAGER      set the default display program
 """
@@ -28,7 +45,14 @@ class Config:
     def __init__(self, config_file=None, use_env=True):
         self.man_paths = []
         self.cache_dir = None
+        self.cache_layers = []
         self.pager = None
+        self.backend = BACKEND_JSON
+        self.max_books = 0
+        self.max_book_bytes = 0
+        self.result_cache_size = 100
+        self.stats = True
+        self.doc_set = None
         self._set_default()
         if use_env:
             self._set_env()
@@ -48,6 +72,12 @@ class Config:
         # cache dir
         if AMAN_ENV_CACHE_VAR in os.environ:
             self.cache_dir = os.environ[AMAN_ENV_CACHE_VAR]
+        # cache layers
+        if AMAN_ENV_LAYERS_VAR in os.environ:
+            self.cache_layers = os.environ[AMAN_ENV_LAYERS_VAR].split(os.pathsep)
+        # doc set
+        if AMAN_ENV_DOC_SET_VAR in os.environ:
+            self.doc_set = os.environ[AMAN_ENV_DOC_SET_VAR]
         # pager
         if AMAN_ENV_PAGER_VAR in os.environ:
             self.pager = os.environ[AMAN_ENV_PAGER_VAR]
@@ -74,8 +104,22 @@ class Config:
             self.man_paths = data[MAN_PATHS_TAG]
         if CACHE_DIR_TAG in data:
             self.cache_dir = data[CACHE_DIR_TAG]
+        if CACHE_LAYERS_TAG in data:
+            self.cache_layers = data[CACHE_LAYERS_TAG]
         if PAGER_TAG in data:
             self.pager = data[PAGER_TAG]
+        if BACKEND_TAG in data:
+            self.backend = data[BACKEND_TAG]
+        if MAX_BOOKS_TAG in data:
+            self.max_books = data[MAX_BOOKS_TAG]
+        if MAX_BOOK_BYTES_TAG in data:
+            self.max_book_bytes = data[MAX_BOOK_BYTES_TAG]
+        if RESULT_CACHE_SIZE_TAG in data:
+            self.result_cache_size = data[RESULT_CACHE_SIZE_TAG]
+        if STATS_TAG in data:
+            self.stats = data[STATS_TAG]
+        if DOC_SET_TAG in data:
+            self.doc_set = data[DOC_SET_TAG]
         return True
 
     def dump(self, config_file):
@@ -83,7 +127,14 @@ class Config:
             VERSION_TAG: JSON_VERSION,
             MAN_PATHS_TAG: self.man_paths,
             CACHE_DIR_TAG: self.cache_dir,
+            CACHE_LAYERS_TAG: self.cache_layers,
             PAGER_TAG: self.pager,
+            BACKEND_TAG: self.backend,
+            MAX_BOOKS_TAG: self.max_books,
+            MAX_BOOK_BYTES_TAG: self.max_book_bytes,
+            RESULT_CACHE_SIZE_TAG: self.result_cache_size,
+            STATS_TAG: self.stats,
+            DOC_SET_TAG: self.doc_set,
         }
         logging.info("config is: %s", data)
         with open(config_file, "w") as fh:
@@ -98,27 +149,99 @@ class Config:
     def set_cache_dir(self, cache_dir):
         self.cache_dir = cache_dir
 
+    def set_cache_layers(self, cache_layers):
+        self.cache_layers = cache_layers
+
     def set_pager(self, pager):
         self.pager = pager
 
+    def set_backend(self, backend):
+        self.backend = backend
+
+    def set_doc_set(self, doc_set):
+        self.doc_set = doc_set
+
+    def set_book_budget(self, max_books, max_book_bytes):
+        self.max_books = max_books
+        self.max_book_bytes = max_book_bytes
+
     def get_cache_dir(self):
         return self.cache_dir
 
+    def get_cache_layers(self):
+        """read-only bundle dirs searched before the cache dir"""
+        return self.cache_layers
+
     def get_man_paths(self):
-        return self.man_paths
+        """man paths of the selected doc set and all paths without doc set"""
+        if not self.doc_set:
+            return self.man_paths
+        result = []
+        for man_path in self.man_paths:
+            doc_set, _ = split_man_path(man_path)
+            if doc_set is None or doc_set == self.doc_set:
+                result.append(man_path)
+        return result
+
+    def get_doc_set(self):
+        return self.doc_set
+
+    def get_doc_sets(self):
+        """names of all doc sets given in the man paths"""
+        result = []
+        for man_path in self.man_paths:
+            doc_set, _ = split_man_path(man_path)
+            if doc_set and doc_set not in result:
+                result.append(doc_set)
+        return result
+
+    def get_index_dir(self):
+        """directory of indices and other caches covering all books.
+        each doc set has its own below the cache dir"""
+        if self.doc_set:
+            return os.path.join(self.cache_dir, "_set_" + self.doc_set)
+        return self.cache_dir
 
     def get_pager(self):
         return self.pager
 
+    def get_backend(self):
+        return self.backend
+
+    def get_max_books(self):
+        return self.max_books
+
+    def get_max_book_bytes(self):
+        return self.max_book_bytes
+
+    def get_stats(self):
+        """record usage statistics in the cache dir?"""
+        return self.stats
+
+    def get_result_cache_size(self):
+        """size of the result cache. 0 disables it"""
+        return self.result_cache_size
+
     def finalize(self):
         # ensure a man path
         if len(self.man_paths) == 0:
             logging.fatal("No path for autodocs given!")
             return False
+        # check doc set
+        if self.doc_set and self.doc_set not in self.get_doc_sets():
+            logging.fatal("Unknown doc set '%s'!", self.doc_set)
+            return False
+        # check backend
+        if self.backend not in BACKENDS:
+            logging.fatal("Invalid backend '%s'!", self.backend)
+            return False
         # ensure cache dir
         if not os.path.isdir(self.cache_dir):
             logging.debug("config: creating cache dir '%s'", self.cache_dir)
             os.makedirs(self.cache_dir)
+        index_dir = self.get_index_dir()
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
         # all fine
         logging.debug("config: finalized")
         return True
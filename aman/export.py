@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import logging
+
+from .autodoc import AutoDoc
+from .cachefile import load_json, save_json
+
+EXPORT_FORMAT_MAN = "man"
+EXPORT_FORMAT_HTML = "html"
+EXPORT_FORMAT_MD = "md"
+EXPORT_FORMAT_JSON = "json"
+EXPORT_FORMATS = (
+    EXPORT_FORMAT_MAN,
+    EXPORT_FORMAT_HTML,
+    EXPORT_FORMAT_MD,
+    EXPORT_FORMAT_JSON,
+)
+
+STATE_FILE = "_export.json"
+VERSION_TAG = "export_version"
+JSON_VERSION = 1
+
+
+def _roff_line(line):
+    line = line.replace("\\", "\\e")
+    if line.startswith(".") or line.startswith("'"):
+        line = "\\&" + line
+    return line
+
+
+def write_man(page, fh):
+    topic, short = page.get_title().split("/")
+    fh.write(f'.TH "{short}" 3 "" "{topic}" "Amiga Autodocs"\n')
+    for section in page.get_toc():
+        if section:
+            fh.write(f'.SH "{section}"\n')
+        fh.write(".nf\n")
+        for line in page.get_section(section):
+            fh.write(_roff_line(line))
+            fh.write("\n")
+        fh.write(".fi\n")
+
+
+def write_html(page, fh):
+    import html
+
+    title = html.escape(page.get_title())
+    fh.write("<!DOCTYPE html>\n<html>\n<head>\n")
+    fh.write(f'<meta charset="utf-8">\n<title>{title}</title>\n')
+    fh.write(f"</head>\n<body>\n<h1>{title}</h1>\n")
+    for section in page.get_toc():
+        if section:
+            fh.write(f"<h2>{html.escape(section)}</h2>\n")
+        fh.write("<pre>\n")
+        for line in page.get_section(section):
+            fh.write(html.escape(line))
+            fh.write("\n")
+        fh.write("</pre>\n")
+    fh.write("</body>\n</html>\n")
+
+
+def write_md(page, fh):
+    fh.write(f"# {page.get_title()}\n")
+    for section in page.get_toc():
+        fh.write("\n")
+        if section:
+            fh.write(f"## {section}\n\n")
+        fh.write("```\n")
+        for line in page.get_section(section):
+            fh.write(line)
+            fh.write("\n")
+        fh.write("```\n")
+
+
+def write_json(page, fh):
+    data = page.to_json()
+    data["title"] = page.get_title()
+    json.dump(data, fh, indent=4)
+
+
+WRITERS = {
+    EXPORT_FORMAT_MAN: (write_man, "3"),
+    EXPORT_FORMAT_HTML: (write_html, "html"),
+    EXPORT_FORMAT_MD: (write_md, "md"),
+    EXPORT_FORMAT_JSON: (write_json, "json"),
+}
+
+
+def get_page_file(book_name, title, export_format):
+    """relative path of the exported page"""
+    _, ext = WRITERS[export_format]
+    topic, short = title.split("/")
+    return os.path.join(book_name, topic, short.replace(os.sep, "_") + "." + ext)
+
+
+def _export_book(doc_info, out_dir, export_format, old_hashes):
+    """worker: render all changed pages of a book. return page infos"""
+    doc = AutoDoc.from_worker_info(doc_info)
+    name = doc.get_name()
+    book = doc.get_book()
+    write_func, _ = WRITERS[export_format]
+    pages = []
+    num_written = 0
+    for title in book.get_toc():
+        page = book.get_page(title)
+        page_hash = page.get_hash()
+        page_file = get_page_file(name, title, export_format)
+        pages.append((title, page_file, page_hash))
+        path = os.path.join(out_dir, page_file)
+        # unchanged source?
+        if old_hashes.get(title) == page_hash and os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as fh:
+            write_func(page, fh)
+        num_written += 1
+    return name, pages, num_written
+
+
+class Export:
+    """render all pages of a doc set into one file per page plus an index"""
+
+    def __init__(self, out_dir, export_format, num_jobs=None):
+        self.out_dir = out_dir
+        self.export_format = export_format
+        self.num_jobs = num_jobs
+        self.state = {}
+
+    def _load_state(self):
+        path = os.path.join(self.out_dir, STATE_FILE)
+        if not os.path.exists(path):
+            return {}
+        data = load_json(path, False)
+        if data.get(VERSION_TAG) != JSON_VERSION:
+            return {}
+        if data.get("format") != self.export_format:
+            return {}
+        return data["books"]
+
+    def _save_state(self, books):
+        path = os.path.join(self.out_dir, STATE_FILE)
+        data = {VERSION_TAG: JSON_VERSION, "format": self.export_format, "books": books}
+        save_json(path, data, False)
+
+    def export(self, doc_set):
+        """export all books. return number of written pages"""
+        start = time.monotonic()
+        os.makedirs(self.out_dir, exist_ok=True)
+        old_state = self._load_state()
+        new_state = {}
+
+        # submit all books with changed source to the pool
+        futures = []
+        num_written = 0
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=self.num_jobs) as pool:
+            for doc in doc_set.get_docs():
+                name = doc.get_name()
+                old_book = old_state.get(name)
+                # whole book unchanged? then skip without loading
+                if self._is_book_unchanged(doc, old_book):
+                    new_state[name] = old_book
+                    logging.info("export: skip book '%s'", name)
+                    continue
+                old_hashes = {}
+                if old_book:
+                    old_hashes = {x[0]: x[2] for x in old_book["pages"]}
+                future = pool.submit(
+                    _export_book,
+                    doc.get_worker_info(),
+                    self.out_dir,
+                    self.export_format,
+                    old_hashes,
+                )
+                futures.append((doc, future))
+
+            for doc, future in futures:
+                name, pages, num = future.result()
+                new_state[name] = {"doc_mtime": doc.get_doc_mtime(), "pages": pages}
+                num_written += num
+                logging.info("export: book '%s' wrote %d pages", name, num)
+
+        self._remove_stale_files(old_state, new_state)
+        self._write_index(new_state)
+        self._save_state(new_state)
+
+        end = time.monotonic()
+        logging.info(
+            "export: %d books to '%s' in %.6f",
+            len(new_state),
+            self.out_dir,
+            end - start,
+        )
+        return num_written
+
+    def _is_book_unchanged(self, doc, old_book):
+        if not old_book or old_book["doc_mtime"] != doc.get_doc_mtime():
+            return False
+        for _, page_file, _ in old_book["pages"]:
+            if not os.path.exists(os.path.join(self.out_dir, page_file)):
+                return False
+        return True
+
+    def _remove_stale_files(self, old_state, new_state):
+        new_files = set()
+        for book in new_state.values():
+            new_files.update(map(lambda x: x[1], book["pages"]))
+        for book in old_state.values():
+            for _, page_file, _ in book["pages"]:
+                if page_file not in new_files:
+                    path = os.path.join(self.out_dir, page_file)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _write_index(self, books):
+        entries = []
+        for name in sorted(books):
+            for title, page_file, _ in books[name]["pages"]:
+                entries.append((name, title, page_file.replace(os.sep, "/")))
+
+        if self.export_format == EXPORT_FORMAT_HTML:
+            import html
+
+            index_file = "index.html"
+            with open(os.path.join(self.out_dir, index_file), "w") as fh:
+                fh.write("<!DOCTYPE html>\n<html>\n<head>\n")
+                fh.write('<meta charset="utf-8">\n<title>Autodocs</title>\n')
+                fh.write("</head>\n<body>\n<h1>Autodocs</h1>\n")
+                last_name = None
+                for name, title, page_file in entries:
+                    if name != last_name:
+                        if last_name:
+                            fh.write("</ul>\n")
+                        fh.write(f"<h2>{html.escape(name)}</h2>\n<ul>\n")
+                        last_name = name
+                    href = html.escape(page_file)
+                    fh.write(f'<li><a href="{href}">{html.escape(title)}</a></li>\n')
+                if last_name:
+                    fh.write("</ul>\n")
+                fh.write("</body>\n</html>\n")
+        elif self.export_format == EXPORT_FORMAT_MD:
+            index_file = "index.md"
+            with open(os.path.join(self.out_dir, index_file), "w") as fh:
+                fh.write("# Autodocs\n")
+                last_name = None
+                for name, title, page_file in entries:
+                    if name != last_name:
+                        fh.write(f"\n## {name}\n\n")
+                        last_name = name
+                    fh.write(f"* [{title}]({page_file})\n")
+        elif self.export_format == EXPORT_FORMAT_JSON:
+            index_file = "index.json"
+            data = {}
+            for name, title, page_file in entries:
+                data.setdefault(name, {})[title] = page_file
+            with open(os.path.join(self.out_dir, index_file), "w") as fh:
+                json.dump(data, fh, indent=4)
+        else:
+            index_file = "index.txt"
+            with open(os.path.join(self.out_dir, index_file), "w") as fh:
+                for name, title, page_file in entries:
+                    fh.write(f"{title}\t{page_file}\n")
+        logging.info("export: wrote index '%s'", index_file)
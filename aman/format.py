@@ -1,10 +1,7 @@
 import json
 import os
-import subprocess
 import logging
 import sys
-import shlex
-from termcolor import colored
 
 
 class PrinterStdout:
@@ -28,6 +25,9 @@ class PrinterFile:
 
 class PrinterPager:
     def __init__(self, pager):
+        import shlex
+        import subprocess
+
         cmd_line = shlex.split(pager)
         logging.info("launching pager: %s", cmd_line)
         self.proc = subprocess.Popen(cmd_line, stdin=subprocess.PIPE, text=True)
@@ -48,6 +48,8 @@ class FormatterMono:
 
 class FormatterColor:
     def format_page(self, page):
+        from termcolor import colored
+
         lines = []
         title = colored(page.get_title(), attrs=["bold"])
         lines.append(title)
@@ -72,6 +74,7 @@ class Format:
         self.output_format = self.OUTPUT_FORMAT_TEXT
         self.pager = None
         self.color = False
+        self.sections = None
 
     def set_output_format(self, output_format):
         self.output_format = output_format
@@ -85,6 +88,13 @@ class Format:
     def set_color(self, color):
         self.color = color
 
+    def set_sections(self, sections):
+        """only output these sections of pages"""
+        self.sections = sections
+
+    def get_sections(self):
+        return self.sections
+
     def _create_printer(self):
         if self.output_file:
             return PrinterFile(self.output_file)
@@ -118,6 +128,57 @@ class Format:
 
         self.format_data(data)
 
+    def format_projections(self, pages):
+        """output the selected sections of all pages at once.
+        json output has one object per line"""
+        chunks = []
+        for page in pages:
+            sections = page.get_projection(self.sections)
+            if self.output_format == self.OUTPUT_FORMAT_JSON:
+                data = {"title": page.get_title(), "sections": sections}
+                chunks.append(json.dumps(data) + os.linesep)
+            else:
+                chunks.append(self._format_projection(page, sections))
+        self.format_data("".join(chunks))
+
+    def _format_projection(self, page, sections):
+        from termcolor import colored
+
+        if self.color:
+            title = colored(page.get_title(), attrs=["bold"])
+        else:
+            title = page.get_title()
+        lines = [title, ""]
+        for name, sec_lines in sections.items():
+            if self.color:
+                name = colored(name, attrs=["bold"])
+            lines.append(name)
+            for line in sec_lines:
+                lines.append("\t" + line)
+            lines.append("")
+        return os.linesep.join(lines) + os.linesep
+
+    def format_proto_rows(self, rows):
+        """output prototype rows as table or one json object per line"""
+        from .proto import format_proto_row
+
+        lines = []
+        for row in rows:
+            if self.output_format == self.OUTPUT_FORMAT_JSON:
+                doc_name, title, name, result, ret, args = row
+                data = {
+                    "book": doc_name,
+                    "page": title,
+                    "name": name,
+                    "result": result,
+                    "ret": ret,
+                    "args": args,
+                }
+                lines.append(json.dumps(data))
+            else:
+                lines.append(format_proto_row(row))
+        self.format_lines(lines)
+
     def format_data(self, data):
         printer = self._create_printer()
         printer.write(data)
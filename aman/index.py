@@ -1,12 +1,103 @@
 import os
 import re
+import sys
 import time
-import json
+import base64
 import logging
-import gzip
+from array import array
+from itertools import accumulate
 
-JSON_VERSION = 1
+from .cachefile import load_json, save_json, CacheLock
+
+JSON_VERSION = 5
 VERSION_TAG = "index_version"
+# cheap indices that are rebuilt together whenever one of them is rebuilt
+STANDARD_INDICES = ("title", "topic_title", "see_also", "section")
+
+# varargs and tag list variants of a function, e.g. OpenScreenTagList
+ALIAS_SUFFIXES = ("TagList", "Tags", "A")
+NAME_LINE_RE = re.compile(r"^([A-Za-z_]\w*(?:\s*[,/]\s*[A-Za-z_]\w*)*)\s+(--?)\s")
+CALL_NAME_RE = re.compile(r"([A-Za-z_]\w*)\s*\(")
+NAME_SPLIT_RE = re.compile(r"[\s,/]+")
+
+
+def get_name_stem(name):
+    """return function name without varargs or tag list suffix"""
+    for suffix in ALIAS_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def get_trigrams(text):
+    """return set of all 3 character substrings of text"""
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def encode_id_gaps(ids):
+    """encode sorted page ids as gaps in the smallest array type.
+
+    The result is the type code followed by the base64 of the little
+    endian array, e.g. 'B' + base64 if all gaps fit into a byte.
+    """
+    gaps = array("I", ids)
+    for i in range(len(gaps) - 1, 0, -1):
+        gaps[i] -= gaps[i - 1]
+    max_gap = max(gaps) if gaps else 0
+    if max_gap < 0x100:
+        gaps = array("B", gaps)
+    elif max_gap < 0x10000:
+        gaps = array("H", gaps)
+    if sys.byteorder != "little":
+        gaps.byteswap()
+    return gaps.typecode + base64.b64encode(gaps.tobytes()).decode("ascii")
+
+
+def decode_id_gaps(data):
+    """return array('I') of page ids encoded by encode_id_gaps"""
+    gaps = array(data[0])
+    gaps.frombytes(base64.b64decode(data[1:]))
+    if sys.byteorder != "little":
+        gaps.byteswap()
+    return array("I", accumulate(gaps))
+
+
+def get_index_path(index_dir, index_name, zip_index):
+    path = os.path.join(index_dir, index_name)
+    if zip_index:
+        path += ".gz"
+    return path
+
+
+def is_index_file_valid(index_file, docs):
+    """index file must exist and be newer than all book caches"""
+    if not os.path.exists(index_file):
+        return False
+    index_mtime = os.stat(index_file).st_mtime
+    for doc in docs:
+        if doc.get_cache_mtime() > index_mtime:
+            return False
+    return True
+
+
+def setup_index_file(
+    docs, index_dir, index_file, load_func, rebuild_func, save_func, force_rebuild
+):
+    """load a valid index file with load_func or rebuild and save it.
+
+    The rebuild runs with the cache lock held and is skipped if another
+    process saved a valid index in the meantime. load_func returns False
+    if the file can't be used. rebuild_func gets the docs.
+    """
+    if not force_rebuild and is_index_file_valid(index_file, docs):
+        if load_func():
+            return
+    with CacheLock(index_dir):
+        if not force_rebuild and is_index_file_valid(index_file, docs):
+            if load_func():
+                return
+        rebuild_func(docs)
+        save_func()
 
 
 class IndexPageRef:
@@ -34,75 +125,156 @@ class IndexPageRef:
 
 
 class IndexEntry:
+    """page refs of an index key partitioned by book: doc_name -> [page_title]"""
+
     def __init__(self):
-        self.page_refs = []
+        self.book_pages = {}
 
     def __repr__(self):
-        return f"IndexEntry({self.page_refs})"
+        return f"IndexEntry({self.book_pages})"
 
     def add_page_ref(self, page_ref):
-        self.page_refs.append(page_ref)
-
-    def get_page_refs(self):
-        return self.page_refs
+        doc_name = page_ref.get_doc_name()
+        titles = self.book_pages.get(doc_name)
+        if titles is None:
+            titles = []
+            self.book_pages[doc_name] = titles
+        titles.append(page_ref.get_page_title())
+
+    def get_doc_names(self):
+        return list(self.book_pages.keys())
+
+    def get_num_page_refs(self):
+        return sum(map(len, self.book_pages.values()))
+
+    def merge(self, entry):
+        """add all page refs of another entry that are not here yet"""
+        for doc_name, other_titles in entry.book_pages.items():
+            titles = self.book_pages.get(doc_name)
+            if titles is None:
+                self.book_pages[doc_name] = list(other_titles)
+            else:
+                for title in other_titles:
+                    if title not in titles:
+                        titles.append(title)
+
+    def get_page_refs(self, limit_books=None):
+        """return page refs. if limit_books is given only refs of these books"""
+        page_refs = []
+        for doc_name, titles in self.book_pages.items():
+            if limit_books and doc_name not in limit_books:
+                continue
+            for title in titles:
+                page_refs.append(IndexPageRef(doc_name, title))
+        return page_refs
 
     def to_json(self):
-        return list(map(lambda x: x.to_json(), self.page_refs))
+        return self.book_pages
 
     @staticmethod
     def from_json(data):
         entry = IndexEntry()
-        for page_ref_data in data:
-            page_ref = IndexPageRef.from_json(page_ref_data)
-            entry.add_page_ref(page_ref)
+        entry.book_pages = data
         return entry
 
 
 class PageIndex:
-    def __init__(self, index_id, keys_func, ignore_case=False):
+    """map keys generated from all pages to IndexEntries.
+
+    A fold_case index is keyed by the lower case key and keeps an entry
+    for each original spelling of it. So both exact and case insensitive
+    searches are answered by the same index.
+    """
+
+    def __init__(self, index_id, keys_func, fold_case=False):
         self.index_id = index_id
         self.keys_func = keys_func
-        self.ignore_case = ignore_case
+        self.fold_case = fold_case
         self.index = None
         self.index_file = None
         self.index_zip = False
 
-    def setup(self, docs, index_dir, force_rebuild=False, zip_index=False):
-        # set cache file name
-        index_name = "_index_" + self.index_id
-        if self.ignore_case:
-            index_name += "_ic"
-        index_name += ".json"
+    def get_index_name(self, zip_index=False):
+        """return file name of index"""
+        index_name = "_index_" + self.index_id + ".json"
         if zip_index:
             index_name += ".gz"
-        index_file = os.path.join(index_dir, index_name)
-        self.index_file = index_file
+        return index_name
+
+    def get_index_file(self):
+        return self.index_file
+
+    def is_fold_case(self):
+        return self.fold_case
+
+    def setup_read_only(self, index_dir, zip_index=False):
+        """only load index from a read-only dir. return False if not possible"""
+        self.index_file = os.path.join(index_dir, self.get_index_name(zip_index))
         self.index_zip = zip_index
+        if not os.path.exists(self.index_file):
+            return False
+        return self._load_index()
+
+    def setup(self, docs, index_dir, force_rebuild=False, zip_index=False):
+        self._set_index_file(index_dir, zip_index)
         # load or rebuild+save index
-        ok = False
-        if not force_rebuild and os.path.exists(self.index_file):
-            ok = self._load_index()
-        if not ok:
-            self._rebuild_index(docs)
-            self._save_index()
+        if not self._try_load(docs, force_rebuild):
+            # rebuild with lock and check if another process already did it
+            with CacheLock(index_dir):
+                if not self._try_load(docs, force_rebuild):
+                    self._rebuild_index(docs)
+                    self._save_index()
         # return entries
         return len(self.index)
 
-    def search(self, key):
-        if self.ignore_case:
-            key = key.lower()
-        return self.index.get(key)
+    def _set_index_file(self, index_dir, zip_index):
+        self.index_file = os.path.join(index_dir, self.get_index_name(zip_index))
+        self.index_zip = zip_index
+
+    def _try_load(self, docs, force_rebuild=False):
+        """load index if it is valid. return True if loaded"""
+        if force_rebuild or not self._is_index_valid(docs):
+            return False
+        return self._load_index()
+
+    def _is_index_valid(self, docs):
+        return is_index_file_valid(self.index_file, docs)
+
+    def search(self, key, ignore_case=False):
+        if not self.fold_case:
+            return self.index.get(key)
+        spellings = self.index.get(key.lower())
+        if not spellings:
+            return None
+        if not ignore_case:
+            return spellings.get(key)
+        if len(spellings) == 1:
+            return next(iter(spellings.values()))
+        # merge refs of all spellings
+        entry = IndexEntry()
+        for spelling_entry in spellings.values():
+            entry.merge(spelling_entry)
+        return entry
+
+    def get_entries(self):
+        """return dict of all keys and their entries.
+        a fold_case index maps lower case keys to dicts of spelling -> entry"""
+        return self.index
+
+    def get_keys(self):
+        """return all keys in their original spelling"""
+        if not self.fold_case:
+            return list(self.index.keys())
+        keys = []
+        for spellings in self.index.values():
+            keys.extend(spellings.keys())
+        return keys
 
     def _load_index(self):
         start = time.monotonic()
 
         # load index file
-        if self.index_zip:
-            with gzip.open(self.index_file, "rt") as fh:
-                data = json.load(fh)
-        else:
-            with open(self.index_file) as fh:
-                data = json.load(fh)
+        data = load_json(self.index_file, self.index_zip)
 
         # check version
         if VERSION_TAG not in data:
@@ -111,11 +283,16 @@ class PageIndex:
             return False
 
         # load entries
-        index = data["index"]
-        self.index = {}
-        for key, entry_data in index.items():
-            entry = IndexEntry.from_json(entry_data)
-            self.index[key] = entry
+        index = {}
+        for key, entry_data in data["index"].items():
+            if self.fold_case:
+                spellings = {}
+                for spelling, spelling_data in entry_data.items():
+                    spellings[spelling] = IndexEntry.from_json(spelling_data)
+                index[key] = spellings
+            else:
+                index[key] = IndexEntry.from_json(entry_data)
+        self.index = index
 
         end = time.monotonic()
         logging.info("loaded index '%s' in %.6f", self.index_file, end - start)
@@ -127,63 +304,177 @@ class PageIndex:
         # store entries and version
         index = {}
         for key, entry in self.index.items():
-            index[key] = entry.to_json()
+            if self.fold_case:
+                spellings = {}
+                for spelling, spelling_entry in entry.items():
+                    spellings[spelling] = spelling_entry.to_json()
+                index[key] = spellings
+            else:
+                index[key] = entry.to_json()
         data = {VERSION_TAG: JSON_VERSION, "index": index}
 
         # save index file
-        if self.index_zip:
-            with gzip.open(self.index_file, "wt") as fh:
-                json.dump(data, fh)
-        else:
-            with open(self.index_file, "w") as fh:
-                json.dump(data, fh)
+        save_json(self.index_file, data, self.index_zip)
 
         end = time.monotonic()
         logging.info("saved index '%s' in %.6f", self.index_file, end - start)
 
     def _rebuild_index(self, docs):
-        start = time.monotonic()
-
-        self.index = {}
-        num_keys = 0
-        num_pages = 0
-        # iterate over all books and its pages
-        for doc in docs:
-            book = doc.get_book()
-            for page in book.get_pages().values():
-                # build page_ref: doc_name + page title
-                doc_name = doc.get_name()
-                page_title = page.get_title()
-                page_ref = IndexPageRef(doc_name, page_title)
-
-                # generate keys via key_func from page
-                keys = self.keys_func(page)
-
-                # add keys
-                if keys:
-                    for key in keys:
-                        # ignore case -> lowercase
-                        if self.ignore_case:
-                            key = key.lower()
-                        # new key?
-                        entry = self.index.get(key)
-                        if not entry:
-                            entry = IndexEntry()
-                            self.index[key] = entry
-                        entry.add_page_ref(page_ref)
-                        num_keys += 1
-                    num_pages += 1
-
-        end = time.monotonic()
+        rebuild_indices(docs, [self])
+
+    def _begin_rebuild(self):
+        # build a new dict and swap it in at the end for concurrent readers
+        self.new_index = {}
+        self.num_keys = 0
+        self.num_pages = 0
+
+    def _get_page_keys(self, page):
+        # generate keys via key_func from page
+        return self.keys_func(page)
+
+    def _add_page(self, page_ref, keys):
+        if keys:
+            index = self.new_index
+            for key in keys:
+                # fold case: lower case key -> spelling -> entry
+                entries = index
+                if self.fold_case:
+                    entries = index.get(key.lower())
+                    if entries is None:
+                        entries = {}
+                        index[key.lower()] = entries
+                # new key?
+                entry = entries.get(key)
+                if not entry:
+                    entry = IndexEntry()
+                    entries[key] = entry
+                entry.add_page_ref(page_ref)
+                self.num_keys += 1
+            self.num_pages += 1
+
+    def _end_rebuild(self):
+        self.index = self.new_index
+        self.new_index = None
         logging.info(
-            "rebuild index '%s' with %s pages and %s keys in %.6f",
+            "rebuild index '%s' with %s pages and %s keys",
             self.index_id,
-            num_pages,
-            num_keys,
-            end - start,
+            self.num_pages,
+            self.num_keys,
         )
 
 
+class TrigramIndex(PageIndex):
+    """lower case trigram -> ids of the pages containing it in a line.
+
+    Pages are numbered in the order they are indexed and each trigram keeps
+    a compact array of the gaps between its page ids. The arrays stay
+    encoded after loading and only the trigrams of a query are decoded.
+    """
+
+    def __init__(self):
+        super().__init__("trigram", self.get_page_trigrams)
+        self.pages = []
+
+    @staticmethod
+    def get_page_trigrams(page):
+        trigrams = set()
+        for section in page.get_sections().values():
+            for line in section:
+                trigrams.update(get_trigrams(line.lower()))
+        return trigrams
+
+    def search(self, key, ignore_case=False):
+        """return array of page ids containing the trigram or None"""
+        ids = self.index.get(key)
+        if ids is None:
+            return None
+        if isinstance(ids, str):
+            ids = decode_id_gaps(ids)
+            self.index[key] = ids
+        return ids
+
+    def get_page_ref(self, page_id):
+        doc_name, title = self.pages[page_id]
+        return IndexPageRef(doc_name, title)
+
+    def _load_index(self):
+        start = time.monotonic()
+        data = load_json(self.index_file, self.index_zip)
+        if data.get(VERSION_TAG) != JSON_VERSION:
+            return False
+        self.pages = data["pages"]
+        self.index = data["index"]
+        end = time.monotonic()
+        logging.info("loaded index '%s' in %.6f", self.index_file, end - start)
+        return True
+
+    def _save_index(self):
+        start = time.monotonic()
+        index = {}
+        for trigram, ids in self.index.items():
+            index[trigram] = ids if isinstance(ids, str) else encode_id_gaps(ids)
+        data = {VERSION_TAG: JSON_VERSION, "pages": self.pages, "index": index}
+        save_json(self.index_file, data, self.index_zip)
+        end = time.monotonic()
+        logging.info("saved index '%s' in %.6f", self.index_file, end - start)
+
+    def _begin_rebuild(self):
+        super()._begin_rebuild()
+        self.new_pages = []
+
+    def _add_page(self, page_ref, trigrams):
+        page_id = len(self.new_pages)
+        self.new_pages.append((page_ref.get_doc_name(), page_ref.get_page_title()))
+        index = self.new_index
+        for trigram in trigrams:
+            ids = index.get(trigram)
+            if ids is None:
+                ids = array("I")
+                index[trigram] = ids
+            ids.append(page_id)
+        self.num_keys += len(trigrams)
+        self.num_pages += 1
+
+    def _end_rebuild(self):
+        self.pages = self.new_pages
+        self.new_pages = None
+        super()._end_rebuild()
+
+
+def rebuild_indices(docs, indices):
+    """rebuild all indices in a single pass over all pages of the docs.
+
+    An index extracts the keys of a page in _get_page_keys(page) and adds
+    them with _add_page(page_ref, keys). Keys are extracted once per page
+    content, so pages shared by several books are only visited once. Pages
+    are added in book name and TOC order.
+    """
+    start = time.monotonic()
+    page_keys = []
+    for index in indices:
+        index._begin_rebuild()
+        page_keys.append({})
+    # iterate over all books and its pages
+    for doc in sorted(docs, key=lambda x: x.get_name()):
+        doc_name = doc.get_name()
+        book = doc.get_book()
+        for title in book.get_toc():
+            page = book.get_page(title)
+            page_hash = page.get_hash()
+            # build page_ref: doc_name + page title
+            page_ref = IndexPageRef(doc_name, title)
+            for index, known_keys in zip(indices, page_keys):
+                keys = known_keys.get(page_hash)
+                if keys is None:
+                    keys = index._get_page_keys(page)
+                    known_keys[page_hash] = keys
+                index._add_page(page_ref, keys)
+    for index in indices:
+        index._end_rebuild()
+    end = time.monotonic()
+    logging.info("rebuild %d indices in %.6f", len(indices), end - start)
+
+
 class PageIndices:
     def __init__(self):
         self.indices = []
@@ -191,21 +482,47 @@ class PageIndices:
     def add_index(self, index):
         self.indices.append(index)
 
-    def add_topic_title_index(self, ignore_case=True):
+    def get_indices(self):
+        return self.indices
+
+    def add_topic_title_index(self):
         def key_func(page):
             return [page.get_title()]
 
-        index = PageIndex("topic_title", key_func, ignore_case=ignore_case)
+        index = PageIndex("topic_title", key_func, fold_case=True)
         self.add_index(index)
         return index
 
-    def add_title_index(self, ignore_case=True):
-        def key_func(page):
-            title = page.get_title()
-            _, short = title.split("/")
-            return [short]
-
-        index = PageIndex("title", key_func, ignore_case=ignore_case)
+    def get_title_keys(self, page):
+        """return short title and the aliases of a page.
+
+        Aliases are all names in front of the '--' in the NAME section and
+        the variants of the title called in the SYNOPSIS section, e.g.
+        AllocAslRequestTags on the page of AllocAslRequest.
+        """
+        _, short = page.get_title().split("/")
+        aliases = set()
+        name = page.find_section("NAME")
+        if name:
+            for pos, line in enumerate(name):
+                match = NAME_LINE_RE.match(line.strip())
+                # a single dash is only accepted in the first line
+                if match and (pos == 0 or match.group(2) == "--"):
+                    aliases.update(NAME_SPLIT_RE.split(match.group(1)))
+        synopsis = page.find_section("SYNOPSIS")
+        if synopsis:
+            stem = get_name_stem(short)
+            for line in synopsis:
+                for call_name in CALL_NAME_RE.findall(line):
+                    if get_name_stem(call_name) == stem:
+                        aliases.add(call_name)
+        aliases.discard(short)
+        aliases.discard("")
+        return [short] + sorted(aliases)
+
+    def add_title_index(self):
+        """index short title and its aliases -> pages"""
+        index = PageIndex("title", self.get_title_keys, fold_case=True)
         self.add_index(index)
         return index
 
@@ -215,35 +532,102 @@ class PageIndices:
         e = e.replace("(2)", "")  # some bsdsocket functions use this
         return e
 
-    def add_see_also_index(self, ignore_case=True):
+    def get_see_also_keys(self, page):
+        see_also = page.find_section("SEE ALSO")
+        if see_also:
+            data = ", ".join(see_also)
+            entries = data.split(",")
+            keys = []
+            for entry in entries:
+                e = self._sanitize_entry(entry)
+                if e:
+                    keys.append(e)
+            return keys
+
+    def add_see_also_index(self):
+        index = PageIndex("see_also", self.get_see_also_keys, fold_case=True)
+        self.add_index(index)
+        return index
+
+    def add_section_index(self):
+        """index section name -> pages containing this section"""
+
         def key_func(page):
-            see_also = page.find_section("SEE ALSO")
-            if see_also:
-                data = ", ".join(see_also)
-                entries = data.split(",")
-                keys = []
-                for entry in entries:
-                    e = self._sanitize_entry(entry)
-                    if e:
-                        keys.append(e)
-                return keys
-
-        index = PageIndex("see_also", key_func, ignore_case=ignore_case)
+            return [name for name in page.get_toc() if name]
+
+        index = PageIndex("section", key_func)
+        self.add_index(index)
+        return index
+
+    def add_trigram_index(self):
+        """index lower case trigram -> pages containing it in a line"""
+        index = TrigramIndex()
         self.add_index(index)
         return index
 
+    def add_standard_index(self, index_id):
+        """add one of the STANDARD_INDICES by its id"""
+        if index_id == "title":
+            return self.add_title_index()
+        elif index_id == "topic_title":
+            return self.add_topic_title_index()
+        elif index_id == "see_also":
+            return self.add_see_also_index()
+        elif index_id == "section":
+            return self.add_section_index()
+
+    def _get_stale_companions(self, docs, index_dir, zip_index, force_rebuild):
+        """return the other standard indices that need a rebuild, too"""
+        own_ids = set(map(lambda x: x.index_id, self.indices))
+        companions = PageIndices()
+        for index_id in STANDARD_INDICES:
+            if index_id not in own_ids:
+                companions.add_standard_index(index_id)
+        result = []
+        for index in companions.get_indices():
+            index._set_index_file(index_dir, zip_index)
+            if force_rebuild or not index._is_index_valid(docs):
+                result.append(index)
+        return result
+
     def setup(self, doc_set, index_dir, force_rebuild=False, zip_index=False):
         num_entries = 0
         num_indices = 0
         docs = doc_set.get_docs()
+        bundle = doc_set.get_index_bundle()
         start = time.monotonic()
 
+        pending = []
         for index in self.indices:
-            num_entries += index.setup(
-                docs, index_dir, force_rebuild=force_rebuild, zip_index=zip_index
-            )
+            # use index of a bundle holding exactly our books
+            index_name = index.get_index_name(zip_index)
+            if bundle and not force_rebuild and bundle.has_index(index_name):
+                if index.setup_read_only(bundle.get_dir(), zip_index):
+                    num_indices += 1
+                    continue
+            index._set_index_file(index_dir, zip_index)
+            if not index._try_load(docs, force_rebuild):
+                pending.append(index)
             num_indices += 1
 
+        # rebuild all missing indices and stale companions in a single pass
+        if pending:
+            with CacheLock(index_dir):
+                rebuild = []
+                for index in pending:
+                    if not index._try_load(docs, force_rebuild):
+                        rebuild.append(index)
+                if rebuild:
+                    rebuild += self._get_stale_companions(
+                        docs, index_dir, zip_index, force_rebuild
+                    )
+                    rebuild_indices(docs, rebuild)
+                    for index in rebuild:
+                        index._save_index()
+
+        for index in self.indices:
+            num_entries += len(index.get_entries())
+
         end = time.monotonic()
         logging.info(
             "setup %d indices with %s entries in %.6f (forced=%s)",
@@ -253,8 +637,8 @@ class PageIndices:
             force_rebuild,
         )
 
-    def search(self, key):
+    def search(self, key, ignore_case=False):
         for index in self.indices:
-            entry = index.search(key)
+            entry = index.search(key, ignore_case)
             if entry:
                 return entry
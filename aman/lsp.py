@@ -0,0 +1,251 @@
+"""minimal language server for autodoc hover and completion in C sources"""
+
+import re
+import sys
+import json
+import time
+import bisect
+import logging
+
+CONTENT_LENGTH = b"Content-Length:"
+HOVER_SECTIONS = ("NAME", "SYNOPSIS")
+MAX_COMPLETIONS = 100
+
+# json-rpc error codes
+ERROR_PARSE = -32700
+ERROR_METHOD_NOT_FOUND = -32601
+ERROR_INTERNAL = -32603
+ERROR_NOT_INITIALIZED = -32002
+
+# lsp constants
+SYNC_FULL = 1
+COMPLETION_KIND_FUNCTION = 3
+MARKUP_MARKDOWN = "markdown"
+
+IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def read_message(stream):
+    """read a json-rpc message with its header. return None on end of stream"""
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        if line.startswith(CONTENT_LENGTH):
+            length = int(line[len(CONTENT_LENGTH) :])
+    if length is None:
+        raise ValueError("no Content-Length in header")
+    body = stream.read(length)
+    if len(body) < length:
+        return None
+    return json.loads(body)
+
+
+def write_message(stream, msg):
+    body = json.dumps(msg, separators=(",", ":")).encode("utf-8")
+    stream.write(b"Content-Length: %d\r\n\r\n" % len(body))
+    stream.write(body)
+    stream.flush()
+
+
+def get_word_at(line, column):
+    """return (start, word) of identifier at or ending at column or None"""
+    for match in IDENT_RE.finditer(line):
+        if match.start() <= column <= match.end():
+            return match.start(), match.group()
+        if match.start() > column:
+            break
+    return None
+
+
+class LspServer:
+    """answer hover and completion requests of an editor via stdio.
+
+    The Session keeps all indices and recently used books in memory. Open
+    documents are synced in full. Columns are taken as character offsets,
+    which matches the UTF-16 offsets of LSP for ASCII sources.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.documents = {}
+        self.initialized = False
+        self.shutdown = False
+        self.handlers = {
+            "initialize": self._initialize,
+            "shutdown": self._shutdown,
+            "textDocument/hover": self._hover,
+            "textDocument/completion": self._completion,
+            "completionItem/resolve": self._resolve,
+        }
+        self.notifications = {
+            "textDocument/didOpen": self._did_open,
+            "textDocument/didChange": self._did_change,
+            "textDocument/didClose": self._did_close,
+        }
+
+    def run(self, in_stream=None, out_stream=None):
+        """serve until exit. return exit code"""
+        if in_stream is None:
+            in_stream = sys.stdin.buffer
+        if out_stream is None:
+            out_stream = sys.stdout.buffer
+        while True:
+            try:
+                msg = read_message(in_stream)
+            except ValueError as e:
+                logging.error("lsp: invalid message: %s", e)
+                write_message(out_stream, self._error(None, ERROR_PARSE, str(e)))
+                continue
+            if msg is None:
+                logging.info("lsp: end of input")
+                return 1
+            method = msg.get("method")
+            if method == "exit":
+                return 0 if self.shutdown else 1
+            reply = self.handle(msg)
+            if reply:
+                write_message(out_stream, reply)
+
+    def handle(self, msg):
+        """handle a request or notification. return reply or None"""
+        method = msg.get("method")
+        params = msg.get("params") or {}
+        # notification
+        if "id" not in msg:
+            handler = self.notifications.get(method)
+            if handler:
+                handler(params)
+            else:
+                logging.debug("lsp: ignore notification '%s'", method)
+            return None
+        # request
+        msg_id = msg["id"]
+        handler = self.handlers.get(method)
+        if not handler:
+            return self._error(msg_id, ERROR_METHOD_NOT_FOUND, f"unknown '{method}'")
+        if not self.initialized and method != "initialize":
+            return self._error(msg_id, ERROR_NOT_INITIALIZED, "not initialized")
+        start = time.monotonic()
+        try:
+            result = handler(params)
+        except Exception as e:
+            logging.exception("lsp: '%s' failed", method)
+            return self._error(msg_id, ERROR_INTERNAL, str(e))
+        end = time.monotonic()
+        logging.info("lsp: '%s' took %.6f", method, end - start)
+        return {"jsonrpc": "2.0", "id": msg_id, "result": result}
+
+    def _error(self, msg_id, code, message):
+        error = {"code": code, "message": message}
+        return {"jsonrpc": "2.0", "id": msg_id, "error": error}
+
+    def _initialize(self, params):
+        self.initialized = True
+        # load title index and keys now and not with the first request
+        self.session.get_title_keys()
+        return {
+            "capabilities": {
+                "textDocumentSync": SYNC_FULL,
+                "hoverProvider": True,
+                "completionProvider": {"resolveProvider": True},
+            },
+            "serverInfo": {"name": "aman"},
+        }
+
+    def _shutdown(self, params):
+        self.shutdown = True
+        return None
+
+    def _did_open(self, params):
+        doc = params["textDocument"]
+        self.documents[doc["uri"]] = doc["text"].split("\n")
+
+    def _did_change(self, params):
+        uri = params["textDocument"]["uri"]
+        changes = params["contentChanges"]
+        # full sync: last change has the whole text
+        if changes:
+            self.documents[uri] = changes[-1]["text"].split("\n")
+
+    def _did_close(self, params):
+        self.documents.pop(params["textDocument"]["uri"], None)
+
+    def _get_line(self, params):
+        lines = self.documents.get(params["textDocument"]["uri"])
+        if not lines:
+            return None
+        position = params["position"]
+        line_no = position["line"]
+        if line_no >= len(lines):
+            return None
+        return line_no, lines[line_no], position["character"]
+
+    def _format_page(self, page):
+        """markdown with NAME and SYNOPSIS of page"""
+        parts = [f"**{page.get_title()}**"]
+        for name in HOVER_SECTIONS:
+            lines = page.find_section(name)
+            if lines:
+                text = "\n".join(lines).strip("\n")
+                parts.append(f"{name}\n```c\n{text}\n```")
+        return "\n\n".join(parts)
+
+    def _get_doc(self, word):
+        pages = self.session.lookup(word)
+        if not pages:
+            return None
+        text = "\n\n---\n\n".join(map(self._format_page, pages))
+        return {"kind": MARKUP_MARKDOWN, "value": text}
+
+    def _hover(self, params):
+        pos = self._get_line(params)
+        if not pos:
+            return None
+        line_no, line, column = pos
+        found = get_word_at(line, column)
+        if not found:
+            return None
+        start, word = found
+        doc = self._get_doc(word)
+        if not doc:
+            return None
+        word_range = {
+            "start": {"line": line_no, "character": start},
+            "end": {"line": line_no, "character": start + len(word)},
+        }
+        return {"contents": doc, "range": word_range}
+
+    def _completion(self, params):
+        pos = self._get_line(params)
+        if not pos:
+            return None
+        _, line, column = pos
+        found = get_word_at(line, column)
+        if not found:
+            return None
+        start, word = found
+        prefix = word[: column - start]
+        if not prefix:
+            return None
+        # prefix scan in sorted keys
+        keys = self.session.get_title_keys()
+        pos = bisect.bisect_left(keys, prefix)
+        items = []
+        while pos < len(keys) and keys[pos].startswith(prefix):
+            if len(items) == MAX_COMPLETIONS:
+                return {"isIncomplete": True, "items": items}
+            key = keys[pos]
+            items.append({"label": key, "kind": COMPLETION_KIND_FUNCTION})
+            pos += 1
+        return {"isIncomplete": False, "items": items}
+
+    def _resolve(self, item):
+        doc = self._get_doc(item["label"])
+        if doc:
+            item["documentation"] = doc
+        return item
@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+
+from .cachefile import load_json, save_json
+
+PAGES_DIR = "_pages"
+INDEX_NAME = "_index.json"
+VERSION_TAG = "pages_version"
+JSON_VERSION = 1
+
+
+def get_page_hash(title, raw_page):
+    """return content address of a page"""
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(title.encode("utf-8"))
+    h.update(b"\n")
+    h.update(raw_page.encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_pack_path(cache_dir, pack, zip):
+    path = os.path.join(cache_dir, PAGES_DIR, pack + ".json")
+    if zip:
+        path += ".gz"
+    return path
+
+
+def load_pack(cache_dir, pack, zip):
+    """return dict of page hash -> page data of a pack or None"""
+    path = get_pack_path(cache_dir, pack, zip)
+    if not os.path.exists(path):
+        logging.error("page pack '%s' is missing", path)
+        return None
+    data = load_json(path, zip)
+    if data.get(VERSION_TAG) != JSON_VERSION:
+        logging.error("page pack '%s' has wrong version", path)
+        return None
+    return data["pages"]
+
+
+class PageStore:
+    """content addressed storage of parsed pages shared by all books.
+
+    Pages are addressed by the hash of their title and raw text. The pages
+    a book build adds are written into an immutable pack file named by the
+    hashes it contains. Book caches only refer to the pack of each page, so
+    a page found in several books (e.g. NDK versions) is parsed and stored
+    once. The store index (page hash -> pack) is only needed for builds.
+    """
+
+    def __init__(self, cache_dir, zip=True):
+        self.cache_dir = cache_dir
+        self.zip = zip
+        self.index_file = os.path.join(cache_dir, PAGES_DIR, INDEX_NAME)
+        if zip:
+            self.index_file += ".gz"
+        self.index = None
+        self.valid_packs = {}
+        self.dirty = False
+
+    def __repr__(self):
+        return f"PageStore({self.cache_dir})"
+
+    def get_cache_dir(self):
+        return self.cache_dir
+
+    def reset(self):
+        """forget all stored pages, e.g. on a forced rebuild"""
+        self.index = {}
+        self.valid_packs = {}
+
+    def reload(self):
+        """read the index again on next use, e.g. after taking the cache lock"""
+        if not self.dirty:
+            self.index = None
+            self.valid_packs = {}
+
+    def _load_index(self):
+        self.index = {}
+        if not os.path.exists(self.index_file):
+            return
+        data = load_json(self.index_file, self.zip)
+        if data.get(VERSION_TAG) == JSON_VERSION:
+            self.index = data["index"]
+
+    def _has_pack(self, pack):
+        valid = self.valid_packs.get(pack)
+        if valid is None:
+            valid = os.path.exists(get_pack_path(self.cache_dir, pack, self.zip))
+            self.valid_packs[pack] = valid
+        return valid
+
+    def find_pack(self, page_hash):
+        """return name of the pack holding the page or None"""
+        if self.index is None:
+            self._load_index()
+        pack = self.index.get(page_hash)
+        if pack and self._has_pack(pack):
+            return pack
+        return None
+
+    def add_pages(self, pages):
+        """store dict of page hash -> page data in a new pack. return its name"""
+        import hashlib
+
+        start = time.monotonic()
+        if self.index is None:
+            self._load_index()
+        h = hashlib.sha1()
+        for page_hash in sorted(pages):
+            h.update(page_hash.encode("ascii"))
+        pack = h.hexdigest()
+        os.makedirs(os.path.join(self.cache_dir, PAGES_DIR), exist_ok=True)
+        path = get_pack_path(self.cache_dir, pack, self.zip)
+        save_json(path, {VERSION_TAG: JSON_VERSION, "pages": pages}, self.zip)
+        self.valid_packs[pack] = True
+        for page_hash in pages:
+            self.index[page_hash] = pack
+        self.dirty = True
+        end = time.monotonic()
+        logging.info(
+            "stored %d pages in pack '%s' in %.6f", len(pages), pack, end - start
+        )
+        return pack
+
+    def remove_unused_packs(self, used_packs):
+        """remove all packs not in used_packs. return number of removed packs"""
+        pages_dir = os.path.join(self.cache_dir, PAGES_DIR)
+        if not os.path.isdir(pages_dir):
+            return 0
+        ext = ".json.gz" if self.zip else ".json"
+        removed = set()
+        for file in os.listdir(pages_dir):
+            if file.startswith("_") or not file.endswith(ext):
+                continue
+            pack = file[: -len(ext)]
+            if pack not in used_packs:
+                os.remove(os.path.join(pages_dir, file))
+                removed.add(pack)
+        if removed:
+            if self.index is None:
+                self._load_index()
+            index = {}
+            for page_hash, pack in self.index.items():
+                if pack not in removed:
+                    index[page_hash] = pack
+            self.index = index
+            for pack in removed:
+                self.valid_packs[pack] = False
+            self.dirty = True
+            self.flush()
+        return len(removed)
+
+    def flush(self):
+        """save the store index if pages were added"""
+        if self.dirty:
+            data = {VERSION_TAG: JSON_VERSION, "index": self.index}
+            save_json(self.index_file, data, self.zip)
+            self.dirty = False
+            logging.info("saved page store index '%s'", self.index_file)
@@ -1,6 +1,8 @@
+import io
 import logging
 
 from .book import AutoDocBook, AutoDocPage
+from .pagestore import get_page_hash
 
 
 class ParseError(Exception):
@@ -40,28 +42,15 @@ def get_section_header(line, indent):
     return heading
 
 
-def remove_empty_sec_lines(sec_lines):
-    """remove empty lines at end and at the beginning"""
-    result = []
-    # empty?
-    if len(sec_lines) == 0:
-        return result
-
-    # first non-empty
+def get_non_empty_range(sec_lines):
+    """return begin, end of lines without empty lines at both ends"""
     begin = 0
-    for line in sec_lines:
-        if len(line) > 0:
-            break
+    end = len(sec_lines)
+    while begin < end and len(sec_lines[begin]) == 0:
         begin += 1
-
-    # last non empty
-    last = len(sec_lines) - 1
-    for line in reversed(sec_lines):
-        if len(line) > 0:
-            break
-        last -= 1
-
-    return sec_lines[begin : last + 1]
+    while end > begin and len(sec_lines[end - 1]) == 0:
+        end -= 1
+    return begin, end
 
 
 def get_min_indent(lines):
@@ -75,37 +64,21 @@ def get_min_indent(lines):
     return min_indent
 
 
-def deindent_sec_lines(sec_lines):
-    indent = get_min_indent(sec_lines)
-    result = []
-    for line in sec_lines:
-        n = len(line)
-        if n > 0:
-            line_indent = get_indent(line)
-            if line_indent == n:
-                # line with only spaces?
-                line = ""
-            else:
-                line = line[indent:]
-        result.append(line)
-    return result
-
-
-def add_section(page, sec_name, sec_lines):
-    # add current first
-    sec_lines = remove_empty_sec_lines(sec_lines)
-    if len(sec_lines) > 0:
-        sec_lines = deindent_sec_lines(sec_lines)
-        page.add_section(sec_name, sec_lines)
-        logging.debug("add section '%s' with %d lines", sec_name, len(sec_lines))
+def add_section(page, sec_name, sec_lines, sec_start):
+    """add section as span. sec_lines start at line sec_start of raw page"""
+    begin, end = get_non_empty_range(sec_lines)
+    if begin < end:
+        indent = get_min_indent(sec_lines[begin:end])
+        page.add_section_span(sec_name, sec_start + begin, sec_start + end, indent)
+        logging.debug("add section '%s' with %d lines", sec_name, end - begin)
     # keep empty names sections
     elif sec_name != "":
-        page.add_section(sec_name, [])
+        page.add_section_span(sec_name, sec_start, sec_start, 0)
         logging.debug("add empty section '%s'", sec_name)
 
 
 def parse_page(title, lines):
-    """parse lines of a page and extract sections"""
+    """parse lines of a page and extract sections as spans of the raw page"""
 
     page = AutoDocPage(title)
 
@@ -115,10 +88,11 @@ def parse_page(title, lines):
 
     sec_name = ""
     sec_lines = []
+    sec_start = 0
     header_indent = 0
 
     # split into sections
-    for line in lines:
+    for line_no, line in enumerate(lines):
         line = cleanup_line(line)
         indent = get_indent(line)
         if indent == 0:
@@ -142,27 +116,34 @@ def parse_page(title, lines):
                         do_add_section = False
                 # really add as a section
                 if do_add_section:
-                    add_section(page, sec_name, sec_lines)
-                    # start new section
+                    add_section(page, sec_name, sec_lines, sec_start)
+                    # start new section after header
                     sec_name = header
                     sec_lines = []
+                    sec_start = line_no + 1
             else:
                 # append to current section
                 sec_lines.append(line)
 
     # add last section
-    add_section(page, sec_name, sec_lines)
+    add_section(page, sec_name, sec_lines, sec_start)
 
     return page
 
 
-def parse_autodoc(file_name):
+def parse_autodoc(file_name, stream=None, is_stored=None):
     """parse autodoc and split into sections.
+    if a binary stream is given then read from it instead of file_name.
+    if is_stored(page_hash) is true then the page is not parsed and only
+    keeps its raw page.
     return AutoDoc"""
 
     # read full file
-    with open(file_name, encoding="latin-1") as fh:
-        data = fh.read()
+    if stream:
+        data = io.TextIOWrapper(stream, encoding="latin-1").read()
+    else:
+        with open(file_name, encoding="latin-1") as fh:
+            data = fh.read()
 
     # split into lines
     lines = data.split("\n")
@@ -218,8 +199,17 @@ def parse_autodoc(file_name):
             page_lines.append(line)
             pos += 1
 
-        # parse page
-        page = parse_page(exp_title, page_lines)
+        # parse page unless it is already stored
+        page_hash = None
+        if is_stored:
+            raw_page = "\n".join(page_lines)
+            page_hash = get_page_hash(exp_title, raw_page)
+        if page_hash and is_stored(page_hash):
+            page = AutoDocPage(exp_title)
+            page.set_raw_page(raw_page)
+        else:
+            page = parse_page(exp_title, page_lines)
+        page.set_hash(page_hash)
         page.set_book(doc)
 
         # add to doc
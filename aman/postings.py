@@ -0,0 +1,274 @@
+import re
+import sys
+import time
+import base64
+import logging
+from array import array
+
+from .cachefile import load_json, save_json
+from .index import IndexPageRef, get_index_path, setup_index_file, rebuild_indices
+
+JSON_VERSION = 1
+VERSION_TAG = "postings_version"
+POSTINGS_FILE = "_postings.json"
+
+WORD_RE = re.compile(r"\w+")
+QUERY_TOKEN_RE = re.compile(r'"[^"]*"|[^\s()"]+(?:\(\))?|\(|\)')
+
+
+def get_words(text):
+    """return lower case words of a text"""
+    return WORD_RE.findall(text.lower())
+
+
+def _encode(ids):
+    if sys.byteorder != "little":
+        ids = array("I", ids)
+        ids.byteswap()
+    return base64.b64encode(ids.tobytes()).decode("ascii")
+
+
+def _decode(data):
+    ids = array("I")
+    ids.frombytes(base64.b64decode(data))
+    if sys.byteorder != "little":
+        ids.byteswap()
+    return ids
+
+
+class PostingIndex:
+    """word -> posting list of page ids stored as typed arrays.
+
+    Page ids number all pages of the docs sorted by name. The posting lists
+    are kept encoded after loading and only decoded if a word is queried.
+    """
+
+    def __init__(self):
+        self.pages = []
+        self.postings = {}
+        self.index_file = None
+        self.index_zip = False
+
+    def setup(self, docs, index_dir, force_rebuild=False, zip_index=False):
+        self.index_file = get_index_path(index_dir, POSTINGS_FILE, zip_index)
+        self.index_zip = zip_index
+        setup_index_file(
+            docs,
+            index_dir,
+            self.index_file,
+            self._load_index,
+            self._rebuild_index,
+            self._save_index,
+            force_rebuild,
+        )
+        return len(self.postings)
+
+    def _load_index(self):
+        start = time.monotonic()
+        data = load_json(self.index_file, self.index_zip)
+        if VERSION_TAG not in data or data[VERSION_TAG] != JSON_VERSION:
+            return False
+        self.pages = data["pages"]
+        self.postings = data["postings"]
+        end = time.monotonic()
+        logging.info("loaded postings '%s' in %.6f", self.index_file, end - start)
+        return True
+
+    def _save_index(self):
+        start = time.monotonic()
+        postings = {}
+        for word, ids in self.postings.items():
+            postings[word] = ids if isinstance(ids, str) else _encode(ids)
+        data = {VERSION_TAG: JSON_VERSION, "pages": self.pages, "postings": postings}
+        save_json(self.index_file, data, self.index_zip)
+        end = time.monotonic()
+        logging.info("saved postings '%s' in %.6f", self.index_file, end - start)
+
+    def _rebuild_index(self, docs):
+        rebuild_indices(docs, [self])
+
+    def _begin_rebuild(self):
+        self.new_pages = []
+        self.new_postings = {}
+
+    def _get_page_keys(self, page):
+        words = set()
+        for section in page.get_sections().values():
+            for line in section:
+                words.update(get_words(line))
+        return words
+
+    def _add_page(self, page_ref, words):
+        page_id = len(self.new_pages)
+        self.new_pages.append((page_ref.get_doc_name(), page_ref.get_page_title()))
+        postings = self.new_postings
+        for word in words:
+            ids = postings.get(word)
+            if ids is None:
+                ids = array("I")
+                postings[word] = ids
+            ids.append(page_id)
+
+    def _end_rebuild(self):
+        self.pages = self.new_pages
+        self.postings = self.new_postings
+        self.new_pages = None
+        self.new_postings = None
+        logging.info(
+            "rebuild postings with %d pages and %d words",
+            len(self.pages),
+            len(self.postings),
+        )
+
+    def get_num_pages(self):
+        return len(self.pages)
+
+    def get_posting(self, word):
+        """return sorted array of page ids containing the word"""
+        ids = self.postings.get(word)
+        if ids is None:
+            return array("I")
+        if isinstance(ids, str):
+            ids = _decode(ids)
+            self.postings[word] = ids
+        return ids
+
+    def get_page_ref(self, page_id):
+        doc_name, title = self.pages[page_id]
+        return IndexPageRef(doc_name, title)
+
+    def get_page_ids(self, doc_names):
+        """return page ids of all pages of the given books"""
+        ids = array("I")
+        for page_id, (doc_name, _) in enumerate(self.pages):
+            if doc_name in doc_names:
+                ids.append(page_id)
+        return ids
+
+
+class BooleanQueryError(Exception):
+    pass
+
+
+class BooleanQuery:
+    """parse and evaluate queries like 'Signal AND port NOT Forbid'.
+
+    Grammar: terms are words or "quoted phrases". Terms next to each other or
+    joined by AND must all match, OR matches either side and NOT excludes the
+    following term. Parentheses group sub expressions. Words match whole words
+    ignoring case.
+
+    The posting lists are combined with set operations that run in C on the
+    whole arrays. Phrases are checked on the pages of their words.
+    """
+
+    def __init__(self, posting_index, page_func):
+        self.posting_index = posting_index
+        self.page_func = page_func
+        self.tokens = []
+        self.pos = 0
+        self.all_ids = None
+
+    def parse(self, text):
+        """return the parsed expression tree"""
+        self.tokens = QUERY_TOKEN_RE.findall(text)
+        self.pos = 0
+        if not self.tokens:
+            raise BooleanQueryError("empty query")
+        expr = self._parse_or()
+        if self.pos != len(self.tokens):
+            raise BooleanQueryError(f"unexpected '{self.tokens[self.pos]}'")
+        return expr
+
+    def search(self, text):
+        """return sorted array of matching page ids"""
+        expr = self.parse(text)
+        ids = self._eval(expr)
+        return array("I", sorted(ids))
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _parse_or(self):
+        expr = self._parse_and()
+        while self._peek() == "OR":
+            self._next()
+            expr = ("or", expr, self._parse_and())
+        return expr
+
+    def _parse_and(self):
+        expr = self._parse_unary()
+        while True:
+            token = self._peek()
+            if token is None or token in ("OR", ")"):
+                return expr
+            if token == "AND":
+                self._next()
+            expr = ("and", expr, self._parse_unary())
+
+    def _parse_unary(self):
+        token = self._next()
+        if token is None:
+            raise BooleanQueryError("missing term")
+        if token == "NOT":
+            return ("not", self._parse_unary())
+        if token == "(":
+            expr = self._parse_or()
+            if self._next() != ")":
+                raise BooleanQueryError("missing ')'")
+            return expr
+        if token in ("AND", "OR", ")"):
+            raise BooleanQueryError(f"unexpected '{token}'")
+        if token.startswith('"'):
+            return ("phrase", token[1:-1])
+        words = get_words(token)
+        if len(words) == 1:
+            return ("word", words[0])
+        return ("phrase", token)
+
+    def _eval(self, expr):
+        op = expr[0]
+        if op == "word":
+            return set(self.posting_index.get_posting(expr[1]))
+        elif op == "phrase":
+            return self._eval_phrase(expr[1])
+        elif op == "not":
+            return self._get_all_ids() - self._eval(expr[1])
+        elif op == "and":
+            # a NOT on the right side only subtracts
+            if expr[2][0] == "not":
+                return self._eval(expr[1]) - self._eval(expr[2][1])
+            return self._eval(expr[1]) & self._eval(expr[2])
+        elif op == "or":
+            return self._eval(expr[1]) | self._eval(expr[2])
+
+    def _eval_phrase(self, phrase):
+        words = get_words(phrase)
+        if not words:
+            return set()
+        ids = set(self.posting_index.get_posting(words[0]))
+        for word in words[1:]:
+            ids.intersection_update(self.posting_index.get_posting(word))
+        # check phrase on candidate pages
+        # pad with blanks so only whole words match
+        needle = " " + " ".join(words) + " "
+        result = set()
+        for page_id in ids:
+            page = self.page_func(self.posting_index.get_page_ref(page_id))
+            for section in page.get_sections().values():
+                text = " " + " ".join(get_words(" ".join(section))) + " "
+                if needle in text:
+                    result.add(page_id)
+                    break
+        return result
+
+    def _get_all_ids(self):
+        if self.all_ids is None:
+            self.all_ids = set(range(self.posting_index.get_num_pages()))
+        return self.all_ids
@@ -0,0 +1,399 @@
+import re
+import time
+import logging
+
+from .cachefile import load_json, save_json
+from .index import (
+    IndexPageRef,
+    get_index_path,
+    rebuild_indices,
+    setup_index_file,
+)
+
+JSON_VERSION = 1
+VERSION_TAG = "protos_version"
+PROTOS_FILE = "_protos.json"
+
+CALL_RE = re.compile(r"^(?:(\w+)\s*=\s*)?(\w+)\s*\(([^()]*)\)?\s*$")
+REG_RE = re.compile(r"^[AD][0-7](?:[/:,-][AD]?[0-7])*$")
+WORD_RE = re.compile(r"\w+")
+TYPE_QUALIFIERS = ("struct", "union", "enum", "unsigned", "signed", "const")
+QUERY_FIELDS = ("arg", "ret", "reg", "result", "name")
+QUERY_FIELD_RE = re.compile(r"(?:^|\s+)(" + "|".join(QUERY_FIELDS) + r")=")
+
+
+def normalize_type(text):
+    """collapse white space and attach pointer stars: 'struct Foo *'"""
+    text = " ".join(text.split())
+    text = re.sub(r"\s*\*\s*", "*", text)
+    return text.replace("*", " *", 1) if "*" in text else text
+
+
+def get_regs(line):
+    """return register tokens of a register line or None if it is none"""
+    tokens = line.upper().split()
+    if tokens and all(map(REG_RE.match, tokens)):
+        return tokens
+    return None
+
+
+def split_args(text):
+    """split argument list on top level commas"""
+    args = []
+    depth = 0
+    cur = ""
+    for ch in text:
+        if ch == "," and depth == 0:
+            args.append(cur.strip())
+            cur = ""
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        cur += ch
+    if cur.strip():
+        args.append(cur.strip())
+    return args
+
+
+def get_arg_type(arg):
+    """return type of a C argument declaration without its name"""
+    arg = arg.strip()
+    if "(" in arg or arg == "...":
+        return arg
+    if "*" in arg:
+        base, _, name = arg.rpartition("*")
+        if name.strip() and WORD_RE.fullmatch(name.strip()):
+            arg = base + "*"
+        return normalize_type(arg)
+    tokens = arg.split()
+    if len(tokens) >= 2 and tokens[-2] not in TYPE_QUALIFIERS:
+        tokens = tokens[:-1]
+    return normalize_type(" ".join(tokens))
+
+
+def parse_c_proto(text):
+    """parse 'type name(args);'. return (name, return type, arg types)"""
+    pos = text.find("(")
+    end = text.rfind(")")
+    if pos < 0 or end < pos:
+        return None
+    head = text[:pos].strip()
+    match = re.search(r"(\w+)$", head)
+    if not match:
+        return None
+    name = match.group(1)
+    ret_type = normalize_type(head[: match.start()])
+    if not ret_type:
+        return None
+    arg_types = []
+    for arg in split_args(text[pos + 1 : end]):
+        if arg.upper() == "VOID":
+            continue
+        arg_types.append(get_arg_type(arg))
+    return name, ret_type, arg_types
+
+
+def parse_synopsis(lines):
+    """extract prototypes from the lines of a SYNOPSIS section.
+
+    Returns a list of dicts with name, result (register), ret (C return
+    type) and args (list of [name, register, C type]).
+    """
+    calls = []
+    c_protos = {}
+    pending = None
+    num = len(lines)
+    pos = 0
+    while pos < num:
+        line = lines[pos].strip()
+        pos += 1
+        if not line:
+            continue
+        # C prototype: may span multiple lines up to ');'
+        if ";" not in line and "(" in line and not CALL_RE.match(line):
+            while ";" not in line and pos < num and lines[pos].strip():
+                line += " " + lines[pos].strip()
+                pos += 1
+        if line.endswith(";"):
+            proto = parse_c_proto(line[:-1])
+            if proto:
+                c_protos[proto[0]] = proto
+            pending = None
+            continue
+        # register line of the last call
+        regs = get_regs(line)
+        if regs:
+            if pending:
+                _assign_regs(pending, regs)
+            pending = None
+            continue
+        # call line: result = Func(args)
+        match = CALL_RE.match(line)
+        if match:
+            result, name, args = match.groups()
+            # call spans multiple lines
+            while ")" not in line and pos < num and lines[pos].strip():
+                more = lines[pos].strip()
+                pos += 1
+                args += " " + more.rstrip(")")
+                line += more
+            arg_names = [x for x in re.split(r"[\s,]+", args.strip()) if x]
+            pending = {
+                "name": name,
+                "result_name": result,
+                "result": None,
+                "ret": None,
+                "args": [[arg, None, None] for arg in arg_names],
+            }
+            calls.append(pending)
+    # merge C prototypes into calls
+    protos = []
+    for call in calls:
+        c_proto = c_protos.pop(call["name"], None)
+        if c_proto:
+            _, ret_type, arg_types = c_proto
+            call["ret"] = ret_type
+            args = call["args"]
+            for i, arg_type in enumerate(arg_types):
+                if i < len(args):
+                    args[i][2] = arg_type
+                else:
+                    args.append([None, None, arg_type])
+        del call["result_name"]
+        protos.append(call)
+    # prototypes without call, e.g. varargs stubs
+    for name, ret_type, arg_types in c_protos.values():
+        args = [[None, None, arg_type] for arg_type in arg_types]
+        protos.append({"name": name, "result": None, "ret": ret_type, "args": args})
+    return protos
+
+
+def _assign_regs(call, regs):
+    args = call["args"]
+    if call["result_name"] and len(regs) == len(args) + 1:
+        call["result"] = regs[0]
+        regs = regs[1:]
+    elif call["result_name"] and len(regs) != len(args):
+        # best guess: first register is the result
+        call["result"] = regs[0]
+        regs = regs[1:]
+    for arg, reg in zip(args, regs):
+        arg[1] = reg
+
+
+def parse_proto_query(keyword):
+    """split 'arg=struct MsgPort * reg=A1' into list of (field, value).
+    text without field matches any type"""
+    parts = QUERY_FIELD_RE.split(keyword.strip())
+    terms = []
+    if parts[0].strip():
+        terms.append(("type", parts[0].strip()))
+    for i in range(1, len(parts) - 1, 2):
+        value = parts[i + 1].strip()
+        if value:
+            terms.append((parts[i], value))
+    return terms
+
+
+def format_proto_row(row):
+    """compact table line of a prototype row"""
+    doc_name, _, name, result, ret, args = row
+    arg_text = ", ".join(
+        f"{arg_type or '?'} {arg or ''}{'/' + reg if reg else ''}".replace(" /", "/")
+        for arg, reg, arg_type in args
+    )
+    return f"{doc_name:12} {result or '-':6} {ret or '?':24} {name}({arg_text})"
+
+
+class ProtoIndex:
+    """prototypes and register assignments extracted from SYNOPSIS sections.
+
+    Each row holds doc name, page title, function name, result register,
+    C return type and the arguments as [name, register, C type]. Lookup
+    tables by register, result register and type words narrow queries
+    before the rows are checked.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.by_reg = {}
+        self.by_result = {}
+        self.by_word = {}
+        self.index_file = None
+        self.index_zip = False
+
+    def setup(self, docs, index_dir, force_rebuild=False, zip_index=False):
+        self.index_file = get_index_path(index_dir, PROTOS_FILE, zip_index)
+        self.index_zip = zip_index
+        setup_index_file(
+            docs,
+            index_dir,
+            self.index_file,
+            self._load_index,
+            self._rebuild_index,
+            self._save_index,
+            force_rebuild,
+        )
+        self._build_tables()
+        return len(self.rows)
+
+    def _load_index(self):
+        start = time.monotonic()
+        data = load_json(self.index_file, self.index_zip)
+        if data.get(VERSION_TAG) != JSON_VERSION:
+            return False
+        self.rows = data["rows"]
+        end = time.monotonic()
+        logging.info("loaded protos '%s' in %.6f", self.index_file, end - start)
+        return True
+
+    def _save_index(self):
+        start = time.monotonic()
+        data = {VERSION_TAG: JSON_VERSION, "rows": self.rows}
+        save_json(self.index_file, data, self.index_zip)
+        end = time.monotonic()
+        logging.info("saved protos '%s' in %.6f", self.index_file, end - start)
+
+    def _rebuild_index(self, docs):
+        rebuild_indices(docs, [self])
+
+    def _begin_rebuild(self):
+        self.new_rows = []
+
+    def _get_page_keys(self, page):
+        synopsis = page.find_section("SYNOPSIS")
+        return parse_synopsis(synopsis) if synopsis else []
+
+    def _add_page(self, page_ref, protos):
+        doc_name = page_ref.get_doc_name()
+        title = page_ref.get_page_title()
+        for proto in protos:
+            self.new_rows.append(
+                [
+                    doc_name,
+                    title,
+                    proto["name"],
+                    proto["result"],
+                    proto["ret"],
+                    proto["args"],
+                ]
+            )
+
+    def _end_rebuild(self):
+        self.rows = self.new_rows
+        self.new_rows = None
+        logging.info("rebuild protos with %d rows", len(self.rows))
+
+    def _build_tables(self):
+        by_reg = {}
+        by_result = {}
+        by_word = {}
+        for row_id, (_, _, _, result, ret, args) in enumerate(self.rows):
+            words = set()
+            if result:
+                by_result.setdefault(result, []).append(row_id)
+            if ret:
+                words.update(WORD_RE.findall(ret.lower()))
+            for _, reg, arg_type in args:
+                if reg:
+                    for r in re.split(r"[/:,-]", reg):
+                        by_reg.setdefault(r, set()).add(row_id)
+                if arg_type:
+                    words.update(WORD_RE.findall(arg_type.lower()))
+            for word in words:
+                by_word.setdefault(word, []).append(row_id)
+        self.by_reg = by_reg
+        self.by_result = by_result
+        self.by_word = by_word
+
+    def get_rows(self, limit_books=None):
+        if not limit_books:
+            return self.rows
+        return [row for row in self.rows if row[0] in limit_books]
+
+    def _get_candidates(self, terms):
+        """return set of row ids that may match or None for all rows"""
+        candidates = None
+        for field, value in terms:
+            if field == "reg":
+                ids = self.by_reg.get(value.upper(), ())
+            elif field == "result":
+                ids = self.by_result.get(value.upper(), ())
+            elif field in ("arg", "ret", "type"):
+                words = WORD_RE.findall(value.lower())
+                if not words:
+                    continue
+                # any row containing a word that contains the first query word
+                ids = set()
+                for word, word_ids in self.by_word.items():
+                    if words[0] in word:
+                        ids.update(word_ids)
+            else:
+                continue
+            ids = set(ids)
+            candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def _match_row(self, row, terms, ignore_case):
+        _, _, name, result, ret, args = row
+
+        def has(text, value):
+            if not text:
+                return False
+            text = normalize_type(text)
+            if ignore_case:
+                return value.lower() in text.lower()
+            return value in text
+
+        for field, value in terms:
+            if field == "name":
+                ok = name.lower() == value.lower() if ignore_case else name == value
+            elif field == "result":
+                ok = result == value.upper()
+            elif field == "reg":
+                ok = any(
+                    reg and value.upper() in re.split(r"[/:,-]", reg)
+                    for _, reg, _ in args
+                )
+            elif field == "ret":
+                ok = has(ret, normalize_type(value))
+            elif field == "arg":
+                ok = any(has(x[2], normalize_type(value)) for x in args)
+            else:
+                value = normalize_type(value)
+                ok = has(ret, value) or any(has(x[2], value) for x in args)
+            if not ok:
+                return False
+        return True
+
+    def search_rows(self, keyword, ignore_case=False, limit_books=None):
+        """return rows matching the query"""
+        terms = parse_proto_query(keyword)
+        if not terms:
+            return []
+        candidates = self._get_candidates(terms)
+        if candidates is None:
+            row_ids = range(len(self.rows))
+        else:
+            row_ids = sorted(candidates)
+        result = []
+        for row_id in row_ids:
+            row = self.rows[row_id]
+            if limit_books and row[0] not in limit_books:
+                continue
+            if self._match_row(row, terms, ignore_case):
+                result.append(row)
+        return result
+
+    def search(self, keyword, ignore_case=False, limit_books=None):
+        """return page refs of the pages with matching prototypes"""
+        page_refs = []
+        seen = set()
+        for row in self.search_rows(keyword, ignore_case, limit_books):
+            key = (row[0], row[1])
+            if key not in seen:
+                seen.add(key)
+                page_refs.append(IndexPageRef(row[0], row[1]))
+        return page_refs
@@ -1,7 +1,85 @@
 import logging
+import os
+import re
 import time
 
-from .index import PageIndices, IndexPageRef
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from .autodoc import AutoDoc
+from .index import PageIndices, IndexPageRef, get_trigrams
+
+# scan in worker processes only if the autodocs have at least this size
+PARALLEL_MIN_BYTES = 1024 * 1024
+
+
+def get_regex_trigrams(pattern):
+    """return the lower case trigrams every match of the regex must contain.
+
+    Only runs of plain literals on the top level of the pattern are
+    considered. An empty set means no prefilter is possible.
+    """
+    literals = []
+    run = []
+    for op, av in sre_parse.parse(pattern):
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+        else:
+            literals.append("".join(run))
+            run = []
+    literals.append("".join(run))
+    trigrams = set()
+    for literal in literals:
+        trigrams.update(get_trigrams(literal.lower()))
+    return trigrams
+
+
+def get_page_search_func(scan, keyword, ignore_case):
+    """return func(page) of a full text scan: 'page' or 'regex'"""
+    if scan == "regex":
+        regex = re.compile(keyword, re.IGNORECASE if ignore_case else 0)
+
+        def page_search(page):
+            for section in page.get_sections().values():
+                for line in section:
+                    if regex.search(line):
+                        return True
+            return False
+
+    else:
+
+        def page_search(page):
+            for section in page.get_sections().values():
+                for line in section:
+                    if ignore_case:
+                        line = line.lower()
+                    if line.find(keyword) != -1:
+                        return True
+            return False
+
+    return page_search
+
+
+def scan_book(book, page_search, max_results=None):
+    """return titles of matching pages of a book. stop after max_results"""
+    titles = []
+    for page in book.get_pages().values():
+        found = page_search(page)
+        logging.info("full search: page %s -> %s", page, found)
+        if found:
+            titles.append(page.get_title())
+            if max_results and len(titles) == max_results:
+                break
+    return titles
+
+
+def _scan_book_worker(doc_info, scan, keyword, ignore_case, max_results):
+    """worker: load book from its cache file and scan its pages"""
+    doc = AutoDoc.from_worker_info(doc_info)
+    page_search = get_page_search_func(scan, keyword, ignore_case)
+    return scan_book(doc.get_book(), page_search, max_results)
 
 
 class Query:
@@ -14,6 +92,41 @@ class Query:
     QUERY_MODE_FULL_SECTION = 3
     QUERY_MODE_FULL_PAGE = 4
 
+    # with trigram prefilter index
+    QUERY_MODE_REGEX = 5
+
+    # with posting lists
+    QUERY_MODE_BOOLEAN = 6
+
+    # with title index and precomputed similarity table
+    QUERY_MODE_RELATED = 7
+
+    # with prototype index of SYNOPSIS sections
+    QUERY_MODE_PROTO = 8
+
+    MODE_NAMES = {
+        QUERY_MODE_PAGE: "page",
+        QUERY_MODE_TOPIC_PAGE: "topic_page",
+        QUERY_MODE_SEE_ALSO: "see_also",
+        QUERY_MODE_FULL_SECTION: "full_section",
+        QUERY_MODE_FULL_PAGE: "full_page",
+        QUERY_MODE_REGEX: "regex",
+        QUERY_MODE_BOOLEAN: "boolean",
+        QUERY_MODE_RELATED: "related",
+        QUERY_MODE_PROTO: "proto",
+    }
+
+    # expensive modes that use the result cache
+    CACHED_MODES = (
+        QUERY_MODE_FULL_SECTION,
+        QUERY_MODE_FULL_PAGE,
+        QUERY_MODE_REGEX,
+        QUERY_MODE_BOOLEAN,
+    )
+
+    # modes that get the keyword unchanged with ignore case
+    RAW_KEYWORD_MODES = (QUERY_MODE_REGEX, QUERY_MODE_BOOLEAN, QUERY_MODE_PROTO)
+
     def __init__(self):
         self.mode = self.QUERY_MODE_PAGE
         self.indices = PageIndices()
@@ -21,46 +134,163 @@ class Query:
         self.limit_books = None
         self.ignore_case = False
         self.section = None
+        self.section_index = None
+        self.trigram_index = None
+        self.posting_index = None
+        self.related_index = None
+        self.proto_index = None
+        self.store = None
+        self.result_cache = None
+        self.search_time = 0.0
+        self.max_results = None
+        self.num_jobs = 1
 
     def set_mode(self, mode):
         self.mode = mode
 
+    def get_mode_name(self):
+        return self.MODE_NAMES[self.mode]
+
+    def get_search_time(self):
+        """total time spent in searches"""
+        return self.search_time
+
     def set_limit_books(self, books):
-        self.limit_books = books
+        if books:
+            self.limit_books = set(books)
+        else:
+            self.limit_books = None
 
     def set_ignore_case(self, ignore_case):
         self.ignore_case = ignore_case
 
+    def set_max_results(self, max_results):
+        """return at most max_results page refs. full scans stop early"""
+        self.max_results = max_results
+
+    def set_num_jobs(self, num_jobs):
+        """number of worker processes for full scans. None uses all cpus"""
+        self.num_jobs = num_jobs
+
     def set_section(self, section):
         self.section = section
 
+    def set_result_cache(self, result_cache):
+        """keep results of expensive searches in a ResultCache"""
+        self.result_cache = result_cache
+
+    def set_store(self, store):
+        """run all searches in a SqlStore instead of indices and books"""
+        self.store = store
+
+    def get_keys(self):
+        """return all keys of the index of the mode or None if it has none"""
+        if not self.indices:
+            return None
+        index = self.indices.get_indices()[0]
+        return index.get_keys()
+
     def _search_index(self, keyword):
-        entry = self.indices.search(keyword)
+        entry = self.indices.search(keyword, self.ignore_case)
         if entry:
-            return entry.get_page_refs()
+            # only materialize refs of the requested books
+            return entry.get_page_refs(self.limit_books)
         else:
             return None
 
-    def _full_search(self, doc_set, keyword, page_search_func):
-        page_refs = []
-        # brute force search through all docs
+    def _get_scan_docs(self, doc_set):
+        docs = []
         for doc in sorted(doc_set.get_docs(), key=lambda x: x.get_name()):
-            # skip books?
-            if self.limit_books:
-                if doc.get_name() in self.limit_books:
-                    logging.info("full search: skip book %s", book)
-                    continue
-            # load book
+            # skip books not in limit set. do this before loading the book
+            if self.limit_books and doc.get_name() not in self.limit_books:
+                logging.info("full search: skip book %s", doc.get_name())
+                continue
+            docs.append(doc)
+        return docs
+
+    def _full_search(self, doc_set, keyword, scan):
+        """brute force scan of all pages of all books in book order"""
+        docs = self._get_scan_docs(doc_set)
+        num_jobs = self.num_jobs
+        # worker processes only pay off for larger doc sets
+        if not num_jobs:
+            doc_bytes = sum(map(lambda x: x.get_doc_size(), docs))
+            if doc_bytes >= PARALLEL_MIN_BYTES:
+                num_jobs = os.cpu_count() or 1
+            else:
+                num_jobs = 1
+        if num_jobs > 1 and len(docs) > 1:
+            return self._parallel_full_search(docs, keyword, scan, num_jobs)
+        page_search = get_page_search_func(scan, keyword, self.ignore_case)
+        page_refs = []
+        for doc in docs:
             book = doc.get_book()
             logging.info("full search: book %s", book)
-            # run through pages
-            for page in book.get_pages().values():
-                # call page search func
-                found = page_search_func(page, keyword)
-                logging.info("full search: page %s -> %s", page, found)
-                if found:
-                    page_ref = IndexPageRef(doc.get_name(), page.get_title())
-                    page_refs.append(page_ref)
+            num = None
+            if self.max_results:
+                num = self.max_results - len(page_refs)
+            for title in scan_book(book, page_search, num):
+                page_refs.append(IndexPageRef(doc.get_name(), title))
+            if self.max_results and len(page_refs) >= self.max_results:
+                logging.info("full search: stop after %d results", len(page_refs))
+                break
+        return page_refs
+
+    def _parallel_full_search(self, docs, keyword, scan, num_jobs):
+        """scan books in worker processes and collect results in book order.
+        outstanding books are cancelled once max_results are found"""
+        from concurrent.futures import ProcessPoolExecutor
+
+        futures = []
+        page_refs = []
+        with ProcessPoolExecutor(max_workers=num_jobs) as pool:
+            try:
+                for doc in docs:
+                    future = pool.submit(
+                        _scan_book_worker,
+                        doc.get_worker_info(),
+                        scan,
+                        keyword,
+                        self.ignore_case,
+                        self.max_results,
+                    )
+                    futures.append((doc.get_name(), future))
+                for doc_name, future in futures:
+                    for title in future.result():
+                        page_refs.append(IndexPageRef(doc_name, title))
+                    if self.max_results and len(page_refs) >= self.max_results:
+                        logging.info(
+                            "full search: stop after %d results", len(page_refs)
+                        )
+                        break
+            finally:
+                # only the running books are waited for on exit
+                for _, future in futures:
+                    future.cancel()
+        logging.info("full search: %d books in %d workers", len(docs), num_jobs)
+        return page_refs
+
+    def _section_search(self, doc_set, keyword):
+        page_refs = []
+        # no section given
+        if not self.section:
+            return page_refs
+        # the section index tells us which pages contain the section
+        entry = self.section_index.search(self.section)
+        if not entry:
+            logging.info("section search: no page with section '%s'", self.section)
+            return page_refs
+        # visit only these pages (sorted by book like the full search)
+        candidates = entry.get_page_refs(self.limit_books)
+        candidates.sort(key=lambda x: x.get_doc_name())
+        for page_ref in candidates:
+            page = doc_set.resolve_page_ref(page_ref)
+            found = self._section_page_search(page, keyword)
+            logging.info("section search: page %s -> %s", page, found)
+            if found:
+                page_refs.append(page_ref)
+                if len(page_refs) == self.max_results:
+                    break
         return page_refs
 
     def _section_page_search(self, page, keyword):
@@ -74,6 +304,7 @@ class Query:
             logging.debug(
                 "section search: '%s' not in %s",
                 self.section,
+                page,
             )
             return False
         # scan through section
@@ -83,44 +314,179 @@ class Query:
             if line.find(keyword) != -1:
                 return True
 
-    def _full_page_search(self, page, keyword):
-        for section in page.get_sections().values():
-            for line in section:
-                if self.ignore_case:
-                    line = line.lower()
-                if line.find(keyword) != -1:
-                    return True
+    def _regex_search(self, doc_set, keyword):
+        # compile pattern
+        flags = re.IGNORECASE if self.ignore_case else 0
+        try:
+            re.compile(keyword, flags)
+            trigrams = get_regex_trigrams(keyword)
+        except re.error as e:
+            logging.error("invalid regex '%s': %s", keyword, e)
+            return None
+
+        # no literal trigrams -> brute force
+        if not trigrams:
+            logging.info("regex search: no trigrams. full search")
+            return self._full_search(doc_set, keyword, "regex")
+        page_search = get_page_search_func("regex", keyword, self.ignore_case)
+
+        # intersect the page ids of all trigrams. rare trigrams first
+        posting_lists = []
+        for trigram in trigrams:
+            ids = self.trigram_index.search(trigram)
+            if not ids:
+                return []
+            posting_lists.append(ids)
+        posting_lists.sort(key=len)
+        candidates = set(posting_lists[0])
+        for ids in posting_lists[1:]:
+            candidates.intersection_update(ids)
+            if not candidates:
+                return []
+        logging.info(
+            "regex search: %d trigrams -> %d candidates", len(trigrams), len(candidates)
+        )
+
+        # run regex on candidates of the requested books
+        candidate_refs = []
+        for page_id in candidates:
+            page_ref = self.trigram_index.get_page_ref(page_id)
+            if self.limit_books and page_ref.get_doc_name() not in self.limit_books:
+                continue
+            candidate_refs.append(page_ref)
+        candidate_refs.sort(key=lambda x: (x.get_doc_name(), x.get_page_title()))
+        page_refs = []
+        for page_ref in candidate_refs:
+            page = doc_set.resolve_page_ref(page_ref)
+            if page_search(page):
+                page_refs.append(page_ref)
+                if len(page_refs) == self.max_results:
+                    break
+        return page_refs
+
+    def _boolean_search(self, doc_set, keyword):
+        from .postings import BooleanQuery, BooleanQueryError
+
+        query = BooleanQuery(self.posting_index, doc_set.resolve_page_ref)
+        try:
+            page_ids = query.search(keyword)
+        except BooleanQueryError as e:
+            logging.error("invalid query '%s': %s", keyword, e)
+            return None
+        # limit books
+        if self.limit_books:
+            book_ids = set(self.posting_index.get_page_ids(self.limit_books))
+            page_ids = sorted(book_ids.intersection(page_ids))
+        return list(map(self.posting_index.get_page_ref, page_ids))
+
+    def _related_search(self, keyword):
+        # find pages of keyword by title
+        page_refs = self._search_index(keyword)
+        if not page_refs:
+            return None
+        # collect their related pages sorted by score
+        scores = {}
+        for page_ref in page_refs:
+            for related_ref, score in self.related_index.get_related(page_ref):
+                doc_name = related_ref.get_doc_name()
+                if self.limit_books and doc_name not in self.limit_books:
+                    continue
+                key = (doc_name, related_ref.get_page_title())
+                scores[key] = max(score, scores.get(key, 0.0))
+        result = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        logging.info("related search: %s", result)
+        return [IndexPageRef(doc_name, title) for (doc_name, title), _ in result]
+
+    def _proto_search(self, keyword):
+        return self.proto_index.search(keyword, self.ignore_case, self.limit_books)
 
     def setup(self, doc_set, cache_dir, force_rebuild, zip_index):
         logging.info("query ignore case: %s", self.ignore_case)
+        # all modes are handled by the store
+        if self.store:
+            logging.info("query mode: %d in store", self.mode)
+
+            def search(keyword):
+                return self.store.search(self, keyword)
+
+            self.search_func = search
+            self.indices = None
+            return
         # search page by title
         if self.mode == self.QUERY_MODE_PAGE:
             logging.info("query mode: page")
-            self.indices.add_title_index(self.ignore_case)
+            self.indices.add_title_index()
         # search page by topic/title
         elif self.mode == self.QUERY_MODE_TOPIC_PAGE:
             logging.info("query mode: topic_page")
-            self.indices.add_topic_title_index(self.ignore_case)
+            self.indices.add_topic_title_index()
         # search in SEE ALSO section
         elif self.mode == self.QUERY_MODE_SEE_ALSO:
             logging.info("query mode: see_also")
-            self.indices.add_see_also_index(self.ignore_case)
+            self.indices.add_see_also_index()
         # non-index searches: search a section
         elif self.mode == self.QUERY_MODE_FULL_SECTION:
+            logging.info("query mode: full_section")
+            self.section_index = self.indices.add_section_index()
 
             def search(keyword):
-                return self._full_search(doc_set, keyword, self._section_page_search)
+                return self._section_search(doc_set, keyword)
 
             self.search_func = search
-            self.indices = None
         # non-index searches: search full page
         elif self.mode == self.QUERY_MODE_FULL_PAGE:
 
             def search(keyword):
-                return self._full_search(doc_set, keyword, self._full_page_search)
+                return self._full_search(doc_set, keyword, "page")
 
             self.search_func = search
             self.indices = None
+        # regex search with trigram prefilter
+        elif self.mode == self.QUERY_MODE_REGEX:
+            logging.info("query mode: regex")
+            self.trigram_index = self.indices.add_trigram_index()
+
+            def search(keyword):
+                return self._regex_search(doc_set, keyword)
+
+            self.search_func = search
+        # related pages of the pages found by title
+        elif self.mode == self.QUERY_MODE_RELATED:
+            logging.info("query mode: related")
+            self.indices.add_title_index()
+            from .related import RelatedIndex
+
+            self.related_index = RelatedIndex()
+            self.related_index.setup(
+                doc_set.get_docs(), cache_dir, force_rebuild, zip_index
+            )
+            self.search_func = self._related_search
+        # boolean search with posting lists
+        elif self.mode == self.QUERY_MODE_BOOLEAN:
+            logging.info("query mode: boolean")
+            from .postings import PostingIndex
+
+            self.posting_index = PostingIndex()
+            self.posting_index.setup(
+                doc_set.get_docs(), cache_dir, force_rebuild, zip_index
+            )
+
+            def search(keyword):
+                return self._boolean_search(doc_set, keyword)
+
+            self.search_func = search
+            self.indices = None
+        # search prototypes by type, register or name
+        elif self.mode == self.QUERY_MODE_PROTO:
+            logging.info("query mode: proto")
+            from .proto import ProtoIndex
+
+            self.proto_index = ProtoIndex()
+            self.proto_index.setup(
+                doc_set.get_docs(), cache_dir, force_rebuild, zip_index
+            )
+            self.search_func = self._proto_search
+            self.indices = None
 
         # setup index if any
         if self.indices:
@@ -128,18 +494,33 @@ class Query:
 
     def search(self, keyword):
         """search for keyword and return one or more page_refs"""
-        if self.ignore_case:
+        # keep regex and boolean queries as is. they handle case themselves
+        if self.ignore_case and self.mode not in self.RAW_KEYWORD_MODES:
             keyword = keyword.lower()
 
+        # repeated expensive search?
+        cache_key = None
+        if self.result_cache and self.mode in self.CACHED_MODES:
+            cache_key = self.result_cache.make_key(
+                self.mode, self.section, keyword, self.ignore_case, self.limit_books
+            )
+            page_refs = self.result_cache.get(cache_key)
+            if page_refs is not None:
+                logging.info("search for '%s' from result cache", keyword)
+                return self._limit_results(page_refs)
+
         start = time.monotonic()
         page_refs = self.search_func(keyword)
         end = time.monotonic()
         logging.info("search for '%s' took %0.6f", keyword, end - start)
+        self.search_time += end - start
 
-        # limit result to books?
-        if not self.limit_books:
-            return page_refs
-        else:
-            return list(
-                filter(lambda x: x.get_doc_name() in self.limit_books, page_refs)
-            )
+        # only keep complete results
+        if cache_key and page_refs is not None and not self.max_results:
+            self.result_cache.put(cache_key, page_refs)
+        return self._limit_results(page_refs)
+
+    def _limit_results(self, page_refs):
+        if page_refs and self.max_results:
+            return page_refs[: self.max_results]
+        return page_refs
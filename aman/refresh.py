@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import threading
+
+from .archive import is_archive, open_archives
+from .autodoc import AutoDoc
+from .cachefile import CacheLock
+from .scan import scan_autodocs, scan_cache, make_unique_names, split_man_path
+
+
+class DocSetRefresher:
+    """poll the autodoc dirs of a set up AutoDocSet and refresh changed books.
+
+    Changed books are parsed in a background thread into a new AutoDocSet.
+    It is passed to swap_func that builds its indices and then swaps it in,
+    so searches keep using the old state and never wait for a rebuild.
+
+    Archives are only scanned again if their size or mtime changed. Dirs are
+    always listed as editing a doc in place does not touch the dir mtime.
+    """
+
+    def __init__(self, doc_set, doc_paths, swap_func, interval=60):
+        self.doc_set = doc_set
+        self.doc_paths = doc_paths
+        self.swap_func = swap_func
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.num_refreshes = 0
+        # archive path -> ((mtime, size), scanned docs)
+        self.archive_scans = {}
+
+    def get_num_refreshes(self):
+        return self.num_refreshes
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self._run, name="aman-refresh", daemon=True
+        )
+        self.thread.start()
+        logging.info("refresh: started with interval %s", self.interval)
+
+    def stop(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            logging.info("refresh: stopped")
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.error("refresh: failed: %s", e)
+
+    def _scan_path(self, man_path):
+        _, base_dir = split_man_path(man_path)
+        if not is_archive(base_dir):
+            return scan_autodocs(man_path, AutoDoc)
+        stat = os.stat(base_dir)
+        stamp = (stat.st_mtime, stat.st_size)
+        entry = self.archive_scans.get(man_path)
+        if entry and entry[0] == stamp:
+            return entry[1]
+        docs = scan_autodocs(man_path, AutoDoc)
+        self.archive_scans[man_path] = (stamp, docs)
+        return docs
+
+    def check(self):
+        """poll the doc paths once and refresh. return True if docs changed"""
+        start = time.monotonic()
+        old_docs = {}
+        for doc in self.doc_set.get_docs():
+            old_docs[doc.get_name()] = doc
+
+        # scan dirs and keep the unchanged docs
+        scanned = []
+        for path in self.doc_paths:
+            scanned += self._scan_path(path)
+        make_unique_names(scanned)
+        docs = []
+        changed = []
+        for doc in scanned:
+            old_doc = old_docs.get(doc.get_name())
+            if (
+                old_doc
+                and old_doc.get_doc_path() == doc.get_doc_path()
+                and old_doc.get_doc_mtime() == doc.get_doc_mtime()
+            ):
+                docs.append(old_doc)
+            else:
+                docs.append(doc)
+                changed.append(doc)
+        new_names = set(map(lambda x: x.get_name(), docs))
+        removed = len(set(old_docs.keys()) - new_names)
+        if not changed and not removed:
+            logging.debug("refresh: no changes")
+            return False
+
+        # parse the changed books off the request path
+        cache_dir = self.doc_set.get_cache_dir()
+        zip_cache = self.doc_set.is_zip_cache()
+        book_cache = self.doc_set.get_book_cache()
+        page_store = self.doc_set.get_page_store()
+        with CacheLock(cache_dir):
+            page_store.reload()
+            scan_cache(cache_dir, changed, zip=zip_cache)
+            with open_archives():
+                for doc in changed:
+                    if book_cache:
+                        doc.set_book_cache(book_cache)
+                    doc.set_page_store(page_store)
+                    doc.setup_cache()
+            page_store.flush()
+            self.doc_set.remove_unused_packs()
+
+        # indices of the new set are built before it is swapped in
+        doc_set = self.doc_set.copy_with_docs(docs)
+        self.swap_func(doc_set)
+        self.doc_set = doc_set
+
+        self.num_refreshes += 1
+        end = time.monotonic()
+        logging.info(
+            "refresh: %d changed and %d removed books in %.6f",
+            len(changed),
+            removed,
+            end - start,
+        )
+        return True
@@ -0,0 +1,167 @@
+import math
+import time
+import heapq
+import logging
+
+from .cachefile import load_json, save_json
+from .index import IndexPageRef, get_index_path, setup_index_file, rebuild_indices
+from .postings import get_words
+
+JSON_VERSION = 1
+VERSION_TAG = "related_version"
+RELATED_FILE = "_related.json"
+
+NUM_RELATED = 10
+MAX_TERMS = 32
+MAX_DF_RATIO = 0.25
+
+
+class RelatedIndex:
+    """precomputed table of the most similar pages of each page.
+
+    Similarity is the cosine of sparse TF-IDF vectors of the page words. Only
+    the strongest terms of each page are kept and very common terms are
+    skipped, so the table can be built with an inverted list instead of a
+    full page by page comparison.
+    """
+
+    def __init__(self, num_related=NUM_RELATED):
+        self.num_related = num_related
+        self.pages = []
+        self.related = []
+        self.page_ids = {}
+        self.index_file = None
+        self.index_zip = False
+
+    def setup(self, docs, index_dir, force_rebuild=False, zip_index=False):
+        self.index_file = get_index_path(index_dir, RELATED_FILE, zip_index)
+        self.index_zip = zip_index
+        setup_index_file(
+            docs,
+            index_dir,
+            self.index_file,
+            self._load_index,
+            self._rebuild_index,
+            self._save_index,
+            force_rebuild,
+        )
+        self.page_ids = {}
+        for page_id, (doc_name, title) in enumerate(self.pages):
+            self.page_ids[(doc_name, title)] = page_id
+        return len(self.pages)
+
+    def _load_index(self):
+        start = time.monotonic()
+        data = load_json(self.index_file, self.index_zip)
+        if VERSION_TAG not in data or data[VERSION_TAG] != JSON_VERSION:
+            return False
+        if data["num_related"] != self.num_related:
+            return False
+        self.pages = data["pages"]
+        self.related = data["related"]
+        end = time.monotonic()
+        logging.info("loaded related '%s' in %.6f", self.index_file, end - start)
+        return True
+
+    def _save_index(self):
+        data = {
+            VERSION_TAG: JSON_VERSION,
+            "num_related": self.num_related,
+            "pages": self.pages,
+            "related": self.related,
+        }
+        save_json(self.index_file, data, self.index_zip)
+        logging.info("saved related '%s'", self.index_file)
+
+    def _rebuild_index(self, docs):
+        rebuild_indices(docs, [self])
+
+    def _begin_rebuild(self):
+        self.new_pages = []
+        self.page_tfs = []
+
+    def _get_page_keys(self, page):
+        """return term frequencies of the page"""
+        tf = {}
+        for section in page.get_sections().values():
+            for line in section:
+                for word in get_words(line):
+                    if len(word) > 1 and not word.isdigit():
+                        tf[word] = tf.get(word, 0) + 1
+        return tf
+
+    def _add_page(self, page_ref, tf):
+        self.new_pages.append((page_ref.get_doc_name(), page_ref.get_page_title()))
+        self.page_tfs.append(tf)
+
+    def _end_rebuild(self):
+        start = time.monotonic()
+        pages = self.new_pages
+        page_tfs = self.page_tfs
+        self.new_pages = None
+        self.page_tfs = None
+
+        # document frequencies of the terms
+        df = {}
+        for tf in page_tfs:
+            for word in tf:
+                df[word] = df.get(word, 0) + 1
+
+        # sparse normalized tf-idf vectors and inverted lists
+        num_pages = len(pages)
+        max_df = max(2, MAX_DF_RATIO * num_pages)
+        inverted = {}
+        vectors = []
+        for page_id, tf in enumerate(page_tfs):
+            vec = []
+            for word, count in tf.items():
+                num = df[word]
+                if num > max_df:
+                    continue
+                weight = (1 + math.log(count)) * math.log(num_pages / num)
+                vec.append((weight, word))
+            vec = heapq.nlargest(MAX_TERMS, vec)
+            norm = math.sqrt(sum(map(lambda x: x[0] * x[0], vec)))
+            if norm > 0:
+                vec = [(word, weight / norm) for weight, word in vec]
+            else:
+                vec = []
+            vectors.append(vec)
+            for word, weight in vec:
+                inverted.setdefault(word, []).append((page_id, weight))
+
+        # accumulate dot products of pages sharing terms
+        related = []
+        for page_id, vec in enumerate(vectors):
+            scores = {}
+            for word, weight in vec:
+                for other_id, other_weight in inverted[word]:
+                    if other_id != page_id:
+                        scores[other_id] = scores.get(other_id, 0.0) + (
+                            weight * other_weight
+                        )
+            best = heapq.nlargest(self.num_related, scores.items(), key=lambda x: x[1])
+            related.append([[other_id, round(score, 4)] for other_id, score in best])
+
+        self.pages = pages
+        self.related = related
+        end = time.monotonic()
+        logging.info(
+            "rebuild related with %d pages and %d terms in %.6f",
+            num_pages,
+            len(inverted),
+            end - start,
+        )
+
+    def get_related(self, page_ref):
+        """return list of (page_ref, score) of the most similar pages"""
+        page_id = self.page_ids.get(
+            (page_ref.get_doc_name(), page_ref.get_page_title())
+        )
+        if page_id is None:
+            return []
+        result = []
+        for other_id, score in self.related[page_id]:
+            doc_name, title = self.pages[other_id]
+            result.append((IndexPageRef(doc_name, title), score))
+        return result
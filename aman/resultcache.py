@@ -0,0 +1,88 @@
+import os
+import json
+import logging
+from collections import OrderedDict
+
+from .cachefile import load_json, save_json
+from .index import IndexPageRef
+
+VERSION_TAG = "results_version"
+JSON_VERSION = 1
+
+
+class ResultCache:
+    """persistent LRU cache of search results.
+
+    All entries belong to a generation of the book set. If the generation
+    differs on load, e.g. because a book cache was rebuilt, then the cache
+    starts empty.
+    """
+
+    def __init__(self, cache_file, max_entries=100, zip=True):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.zip = zip
+        self.generation = None
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.num_hits = 0
+        self.num_lookups = 0
+
+    def __repr__(self):
+        return f"ResultCache({self.cache_file},#entries={len(self.entries)})"
+
+    @staticmethod
+    def make_key(mode, section, keyword, ignore_case, limit_books):
+        if limit_books:
+            limit_books = sorted(limit_books)
+        return json.dumps([mode, section, keyword, ignore_case, limit_books])
+
+    def load(self, generation):
+        self.generation = generation
+        self.entries = OrderedDict()
+        if not os.path.exists(self.cache_file):
+            return False
+        data = load_json(self.cache_file, self.zip)
+        if VERSION_TAG not in data or data[VERSION_TAG] != JSON_VERSION:
+            return False
+        if data["generation"] != generation:
+            logging.info("result cache: new generation. dropping entries")
+            self.dirty = True
+            return False
+        for key, refs in data["entries"]:
+            self.entries[key] = refs
+        logging.info("result cache: loaded %s", self)
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            VERSION_TAG: JSON_VERSION,
+            "generation": self.generation,
+            "entries": list(self.entries.items()),
+        }
+        save_json(self.cache_file, data, self.zip)
+        self.dirty = False
+        logging.info("result cache: saved %s", self)
+
+    def get(self, key):
+        """return list of page_refs or None if not cached"""
+        self.num_lookups += 1
+        refs = self.entries.get(key)
+        if refs is None:
+            return None
+        self.num_hits += 1
+        self.entries.move_to_end(key)
+        self.dirty = True
+        return list(map(IndexPageRef.from_json, refs))
+
+    def get_stats(self):
+        return {"hits": self.num_hits, "lookups": self.num_lookups}
+
+    def put(self, key, page_refs):
+        self.entries[key] = list(map(lambda x: x.to_json(), page_refs))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
@@ -2,8 +2,51 @@ import os
 import time
 import logging
 
+from .archive import is_archive, scan_archive
 
-def scan_autodocs(base_dir, doc_class):
+
+def split_man_path(man_path):
+    """split 'name=path' of a man path in a named doc set into (name, path)"""
+    name, sep, path = man_path.partition("=")
+    if sep and name and os.sep not in name:
+        return name, path
+    return None, man_path
+
+
+def make_unique_names(docs):
+    """rename docs with the name of an earlier doc to 'name@doc_set'"""
+    names = set()
+    for doc in docs:
+        name = doc.get_base_name()
+        if name in names:
+            doc_set_name = doc.get_doc_set_name()
+            if doc_set_name:
+                name += "@" + doc_set_name
+            num = 2
+            unique = name
+            while unique in names:
+                unique = f"{name}@{num}"
+                num += 1
+            name = unique
+        doc.set_name(name)
+        names.add(name)
+
+
+def scan_autodocs(man_path, doc_class):
+    """scan a directory or archive for *.doc autodoc files and return list of AutoDocs.
+    a man path 'name=path' assigns the docs to the doc set name"""
+    doc_set_name, base_dir = split_man_path(man_path)
+    if is_archive(base_dir):
+        result = scan_autodoc_archive(base_dir, doc_class)
+    else:
+        result = scan_autodoc_dir(base_dir, doc_class)
+    if doc_set_name:
+        for doc in result:
+            doc.set_doc_set_name(doc_set_name)
+    return result
+
+
+def scan_autodoc_dir(base_dir, doc_class):
     """scan a directory for *.doc autodoc files and return list of AutoDocs"""
     result = []
     num = 0
@@ -14,17 +57,38 @@ def scan_autodocs(base_dir, doc_class):
             stat = os.stat(path)
             mtime = stat.st_mtime
             name, _ = os.path.splitext(file)
-            result.append(doc_class(name, path, mtime))
+            result.append(doc_class(name, path, mtime, stat.st_size))
             num += 1
     end = time.monotonic()
     logging.info("scanned '%s' (%s files) in %.6f", base_dir, num, end - start)
     return result
 
 
+def scan_autodoc_archive(archive_path, doc_class):
+    """scan a zip or tar archive for *.doc members and return list of AutoDocs"""
+    result = []
+    start = time.monotonic()
+    for member, mtime, size, signature in scan_archive(archive_path):
+        file = os.path.basename(member)
+        name, _ = os.path.splitext(file)
+        path = os.path.join(archive_path, member)
+        doc = doc_class(name, path, mtime, size)
+        doc.set_archive(archive_path, member, signature)
+        result.append(doc)
+    end = time.monotonic()
+    logging.info(
+        "scanned archive '%s' (%s files) in %.6f",
+        archive_path,
+        len(result),
+        end - start,
+    )
+    return result
+
+
 def scan_cache(cache_dir, autodocs, zip):
     """scan the cache directory for the autodocs"""
     for adoc in autodocs:
-        name = adoc.get_name()
+        name = adoc.get_cache_name()
         cache_file = os.path.join(cache_dir, name + ".json")
         if zip:
             cache_file += ".gz"
@@ -0,0 +1,178 @@
+import logging
+import threading
+
+from .autodoc import AutoDocSet
+from .bookcache import BookCache
+from .bundle import CacheBundle
+from .index import IndexPageRef
+from .query import Query
+
+
+class SessionError(Exception):
+    pass
+
+
+def setup_doc_set(doc_set, config, force_rebuild=False):
+    """setup doc set with the json caches. return True if all were valid"""
+    max_books = config.get_max_books()
+    max_book_bytes = config.get_max_book_bytes()
+    if max_books or max_book_bytes:
+        doc_set.set_book_cache(BookCache(max_books, max_book_bytes))
+    # add read-only cache layers
+    for layer in config.get_cache_layers():
+        bundle = CacheBundle(layer)
+        if bundle.load():
+            doc_set.add_bundle(bundle)
+    return doc_set.setup(
+        config.get_man_paths(),
+        config.get_cache_dir(),
+        force_rebuild=force_rebuild,
+        zip_cache=True,
+    )
+
+
+class Session:
+    """use aman as a library: set up the doc set once and run many queries.
+
+    Queries of each mode are set up on first use and then kept warm. All
+    methods can be called from multiple threads.
+
+        session = Session(Config())
+        for page in session.lookup("GetMsg"):
+            print(page.format_txt_lines())
+    """
+
+    def __init__(self, config, force_rebuild=False):
+        if not config.finalize():
+            raise SessionError("invalid config")
+        self.config = config
+        self.index_dir = config.get_index_dir()
+        self.doc_set = AutoDocSet()
+        self.is_clean = setup_doc_set(self.doc_set, config, force_rebuild)
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.title_keys = None
+        self.refresher = None
+
+    def get_doc_set(self):
+        return self.doc_set
+
+    def _setup_query(self, doc_set, mode, force_rebuild):
+        query = Query()
+        query.set_mode(mode)
+        query.setup(doc_set, self.index_dir, force_rebuild, zip_index=True)
+        return (query, threading.Lock())
+
+    def _get_query(self, mode):
+        """return (query, lock, doc_set) of a set up query for the mode.
+        exact and case insensitive searches share the query and its indices"""
+        with self.lock:
+            entry = self.queries.get(mode)
+            if not entry:
+                entry = self._setup_query(self.doc_set, mode, not self.is_clean)
+                self.queries[mode] = entry
+            return entry + (self.doc_set,)
+
+    def query(self, mode, keyword, ignore_case=False, limit_books=None, section=None):
+        """run a search of the given Query mode. return list of AutoDocPages"""
+        query, lock, doc_set = self._get_query(mode)
+        with lock:
+            query.set_ignore_case(ignore_case)
+            query.set_limit_books(limit_books)
+            query.set_section(section)
+            page_refs = query.search(keyword)
+        if not page_refs:
+            return []
+        return doc_set.resolve_page_refs(page_refs)
+
+    def start_refresh(self, interval=60):
+        """poll the autodoc dirs every interval seconds in a background
+        thread and swap in changed books with rebuilt indices"""
+        from .refresh import DocSetRefresher
+
+        if self.refresher:
+            return
+        self.refresher = DocSetRefresher(
+            self.doc_set, self.config.get_man_paths(), self._swap_doc_set, interval
+        )
+        self.refresher.start()
+
+    def stop_refresh(self):
+        if self.refresher:
+            self.refresher.stop()
+            self.refresher = None
+
+    def _swap_doc_set(self, doc_set):
+        """set up the used queries for the refreshed doc set and swap them in
+        together with it. the old state serves searches until then"""
+        with self.lock:
+            modes = list(self.queries)
+        # rebuild: an index file can't tell that books were removed
+        queries = {}
+        for mode in modes:
+            queries[mode] = self._setup_query(doc_set, mode, True)
+        with self.lock:
+            self.doc_set = doc_set
+            self.queries = queries
+            self.title_keys = None
+
+    def lookup(self, keyword, ignore_case=False, limit_books=None):
+        """return pages with the keyword as title"""
+        return self.query(Query.QUERY_MODE_PAGE, keyword, ignore_case, limit_books)
+
+    def see_also(self, keyword, ignore_case=False, limit_books=None):
+        """return pages referring to the keyword in SEE ALSO"""
+        return self.query(Query.QUERY_MODE_SEE_ALSO, keyword, ignore_case, limit_books)
+
+    def search(self, keyword, section=None, ignore_case=False, limit_books=None):
+        """full text search in all pages or only in the given section"""
+        if section:
+            mode = Query.QUERY_MODE_FULL_SECTION
+        else:
+            mode = Query.QUERY_MODE_FULL_PAGE
+        return self.query(mode, keyword, ignore_case, limit_books, section)
+
+    def get_title_keys(self):
+        """return sorted list of all page titles without topic"""
+        with self.lock:
+            keys = self.title_keys
+        if keys is None:
+            query, lock, doc_set = self._get_query(Query.QUERY_MODE_PAGE)
+            with lock:
+                keys = sorted(query.get_keys())
+            with self.lock:
+                # keep no keys of a doc set swapped out in the meantime
+                if self.doc_set is doc_set:
+                    self.title_keys = keys
+        return keys
+
+    def list_books(self):
+        """return list of dicts with name and topics of all books"""
+        result = []
+        for doc in sorted(self.doc_set.get_docs(), key=lambda x: x.get_name()):
+            topics = doc.get_book().get_topics()
+            result.append({"name": doc.get_name(), "topics": topics})
+        return result
+
+    def list_pages(self, book_name):
+        """return page titles of a book or None if book is unknown"""
+        doc = self.doc_set.find_doc(book_name)
+        if doc:
+            return list(doc.get_book().get_toc())
+
+    def get_page(self, title, book_name=None):
+        """return page by 'topic/title' or None if not found"""
+        if book_name:
+            doc_set = self.doc_set
+            doc = doc_set.find_doc(book_name)
+            if not doc:
+                return None
+            page_ref = IndexPageRef(book_name, title)
+            try:
+                return doc_set.resolve_page_ref(page_ref)
+            except KeyError:
+                logging.info("session: no page '%s' in '%s'", title, book_name)
+                return None
+        pages = self.query(Query.QUERY_MODE_TOPIC_PAGE, title)
+        if pages:
+            return pages[0]
@@ -0,0 +1,377 @@
+import os
+import re
+import json
+import time
+import logging
+import sqlite3
+
+from .book import AutoDocPage
+from .cachefile import CacheLock
+from .index import IndexPageRef, PageIndices
+from .query import Query, get_regex_trigrams
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE books (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    doc_path TEXT,
+    doc_mtime REAL,
+    topics TEXT
+);
+CREATE TABLE pages (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER,
+    pos INTEGER,
+    title TEXT,
+    short_title TEXT,
+    toc TEXT,
+    raw_page TEXT
+);
+CREATE INDEX pages_book ON pages(book_id, pos);
+CREATE INDEX pages_title ON pages(title);
+CREATE INDEX pages_title_nc ON pages(title COLLATE NOCASE);
+CREATE INDEX pages_short ON pages(short_title);
+CREATE INDEX pages_short_nc ON pages(short_title COLLATE NOCASE);
+CREATE TABLE sections (
+    page_id INTEGER,
+    pos INTEGER,
+    name TEXT,
+    lines TEXT
+);
+CREATE INDEX sections_page ON sections(page_id, pos);
+CREATE INDEX sections_name ON sections(name);
+CREATE TABLE see_also (
+    page_id INTEGER,
+    key TEXT
+);
+CREATE INDEX see_also_key ON see_also(key);
+CREATE INDEX see_also_key_nc ON see_also(key COLLATE NOCASE);
+CREATE TABLE aliases (
+    page_id INTEGER,
+    key TEXT
+);
+CREATE INDEX aliases_key ON aliases(key);
+CREATE INDEX aliases_key_nc ON aliases(key COLLATE NOCASE);
+CREATE VIRTUAL TABLE page_text USING fts5(text, tokenize='trigram');
+"""
+
+PAGE_SELECT = """
+SELECT b.name, p.title FROM pages p JOIN books b ON p.book_id = b.id
+"""
+
+
+# query modes that need indices the store does not have
+UNSUPPORTED_MODES = (
+    Query.QUERY_MODE_BOOLEAN,
+    Query.QUERY_MODE_RELATED,
+    Query.QUERY_MODE_PROTO,
+)
+
+
+class SqlStoreError(Exception):
+    pass
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+class SqlStore:
+    """store books, pages and sections in a SQLite database and run queries
+    with indexed SQL. Full text searches use a FTS5 trigram table.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        indices = PageIndices()
+        self.see_also_func = indices.get_see_also_keys
+        self.title_keys_func = indices.get_title_keys
+
+    def open(self):
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.create_function("py_lower", 1, lambda x: x.lower())
+        if self._get_version() != SCHEMA_VERSION:
+            with CacheLock(os.path.dirname(self.db_path)):
+                if self._get_version() != SCHEMA_VERSION:
+                    logging.info("sql store: creating schema in '%s'", self.db_path)
+                    self._create_schema()
+
+    def _get_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    def _create_schema(self):
+        with self.conn:
+            tables = self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+                " AND name NOT LIKE 'page_text_%'"
+            ).fetchall()
+            for (table,) in tables:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.executescript(SCHEMA)
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def setup(self, docs, force_rebuild=False):
+        """sync books in store with the given docs. return True if all valid"""
+        start = time.monotonic()
+        all_valid = True
+        changed, removed = self._find_changes(docs, force_rebuild)
+        if changed or removed:
+            all_valid = False
+            # update with lock and check again if another process did it
+            with CacheLock(os.path.dirname(self.db_path)):
+                changed, removed = self._find_changes(docs, force_rebuild)
+                for doc, book_id in changed:
+                    with self.conn:
+                        if book_id is not None:
+                            self._remove_book(book_id)
+                        self._add_book(doc)
+                for name, book_id in removed:
+                    with self.conn:
+                        self._remove_book(book_id)
+                    logging.info("sql store: removed book '%s'", name)
+
+        end = time.monotonic()
+        logging.info(
+            "sql store: setup %d books in %.6f (all valid=%s)",
+            len(docs),
+            end - start,
+            all_valid,
+        )
+        return all_valid
+
+    def _find_changes(self, docs, force_rebuild):
+        """return list of (doc, old book_id) to update and (name, book_id) to remove"""
+        stored = {}
+        for book_id, name, doc_path, doc_mtime in self.conn.execute(
+            "SELECT id, name, doc_path, doc_mtime FROM books"
+        ):
+            stored[name] = (book_id, doc_path, doc_mtime)
+
+        changed = []
+        for doc in docs:
+            entry = stored.pop(doc.get_name(), None)
+            if entry:
+                book_id, doc_path, doc_mtime = entry
+                if (
+                    not force_rebuild
+                    and doc_path == doc.get_doc_path()
+                    and doc_mtime == doc.get_doc_mtime()
+                ):
+                    continue
+                changed.append((doc, book_id))
+            else:
+                changed.append((doc, None))
+
+        removed = [(name, entry[0]) for name, entry in stored.items()]
+        return changed, removed
+
+    def _add_book(self, doc):
+        logging.info("sql store: parsing autodoc from '%s'", doc.get_doc_path())
+        book = doc.parse_doc()
+        cur = self.conn.execute(
+            "INSERT INTO books (name, doc_path, doc_mtime, topics) VALUES (?,?,?,?)",
+            (
+                doc.get_name(),
+                doc.get_doc_path(),
+                doc.get_doc_mtime(),
+                json.dumps(book.get_topics()),
+            ),
+        )
+        book_id = cur.lastrowid
+        for pos, title in enumerate(book.get_toc()):
+            page = book.get_page(title)
+            _, short_title = title.split("/")
+            cur = self.conn.execute(
+                "INSERT INTO pages (book_id, pos, title, short_title, toc, raw_page)"
+                " VALUES (?,?,?,?,?,?)",
+                (
+                    book_id,
+                    pos,
+                    title,
+                    short_title,
+                    json.dumps(page.get_toc()),
+                    page.get_raw_page(),
+                ),
+            )
+            page_id = cur.lastrowid
+            texts = []
+            for sec_pos, sec_name in enumerate(page.get_toc()):
+                lines = "\n".join(page.get_section(sec_name))
+                self.conn.execute(
+                    "INSERT INTO sections (page_id, pos, name, lines) VALUES (?,?,?,?)",
+                    (page_id, sec_pos, sec_name, lines),
+                )
+                texts.append(lines)
+            self.conn.execute(
+                "INSERT INTO page_text (rowid, text) VALUES (?,?)",
+                (page_id, "\n".join(texts)),
+            )
+            keys = self.see_also_func(page)
+            if keys:
+                self.conn.executemany(
+                    "INSERT INTO see_also (page_id, key) VALUES (?,?)",
+                    map(lambda x: (page_id, x), keys),
+                )
+            # first title key is the short title itself
+            aliases = self.title_keys_func(page)[1:]
+            if aliases:
+                self.conn.executemany(
+                    "INSERT INTO aliases (page_id, key) VALUES (?,?)",
+                    map(lambda x: (page_id, x), aliases),
+                )
+
+    def _remove_book(self, book_id):
+        page_ids = "SELECT id FROM pages WHERE book_id = ?"
+        for table, column in (
+            ("sections", "page_id"),
+            ("see_also", "page_id"),
+            ("aliases", "page_id"),
+            ("page_text", "rowid"),
+        ):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE {column} IN ({page_ids})", (book_id,)
+            )
+        self.conn.execute("DELETE FROM pages WHERE book_id = ?", (book_id,))
+        self.conn.execute("DELETE FROM books WHERE id = ?", (book_id,))
+
+    def get_books(self):
+        """return list of (name, topics) of all books"""
+        result = []
+        for name, topics in self.conn.execute(
+            "SELECT name, topics FROM books ORDER BY name"
+        ):
+            result.append((name, json.loads(topics)))
+        return result
+
+    def get_toc(self, book_name):
+        """return page titles of a book or None if book is unknown"""
+        rows = self.conn.execute(
+            "SELECT p.title FROM pages p JOIN books b ON p.book_id = b.id"
+            " WHERE b.name = ? ORDER BY p.pos",
+            (book_name,),
+        ).fetchall()
+        if rows:
+            return [row[0] for row in rows]
+
+    def get_section_counts(self):
+        """return list of (section name, number of pages)"""
+        return self.conn.execute(
+            "SELECT name, count(*) FROM sections WHERE name != ''"
+            " GROUP BY name ORDER BY name"
+        ).fetchall()
+
+    def is_mode_supported(self, mode):
+        return mode not in UNSUPPORTED_MODES
+
+    def search(self, query, keyword):
+        """run the search of the given query. return page_refs"""
+        mode = query.mode
+        if not self.is_mode_supported(mode):
+            raise SqlStoreError(f"{query.get_mode_name()} search is not supported")
+        ignore_case = query.ignore_case
+        collate = " COLLATE NOCASE" if ignore_case else ""
+        if mode == Query.QUERY_MODE_PAGE:
+            where = (
+                f"(p.short_title = ?{collate} OR p.id IN"
+                f" (SELECT page_id FROM aliases WHERE key = ?{collate}))"
+            )
+            args = [keyword, keyword]
+        elif mode == Query.QUERY_MODE_TOPIC_PAGE:
+            where = f"p.title = ?{collate}"
+            args = [keyword]
+        elif mode == Query.QUERY_MODE_SEE_ALSO:
+            where = f"p.id IN (SELECT page_id FROM see_also WHERE key = ?{collate})"
+            args = [keyword]
+        elif mode == Query.QUERY_MODE_FULL_SECTION:
+            lines = "py_lower(s.lines)" if ignore_case else "s.lines"
+            where = (
+                "p.id IN (SELECT s.page_id FROM sections s"
+                f" WHERE s.name = ? AND instr({lines}, ?) > 0)"
+            )
+            args = [query.section, keyword]
+        elif mode == Query.QUERY_MODE_FULL_PAGE:
+            text = "py_lower(text)" if ignore_case else "text"
+            where = f"p.id IN (SELECT rowid FROM page_text WHERE instr({text}, ?) > 0"
+            args = [keyword]
+            # the trigram index needs at least 3 chars
+            if len(keyword) >= 3:
+                where += " AND page_text MATCH ?"
+                args.append(_fts_phrase(keyword))
+            where += ")"
+        elif mode == Query.QUERY_MODE_REGEX:
+            return self._regex_search(query, keyword)
+        else:
+            return None
+        return self._select_page_refs(where, args, query.limit_books)
+
+    def _regex_search(self, query, keyword):
+        flags = re.IGNORECASE if query.ignore_case else 0
+        try:
+            regex = re.compile(keyword, flags)
+            trigrams = get_regex_trigrams(keyword)
+        except re.error as e:
+            logging.error("invalid regex '%s': %s", keyword, e)
+            return None
+
+        def regexp(text):
+            for line in text.split("\n"):
+                if regex.search(line):
+                    return True
+            return False
+
+        self.conn.create_function("py_regexp", 1, regexp)
+        where = "p.id IN (SELECT rowid FROM page_text WHERE py_regexp(text)"
+        args = []
+        if trigrams:
+            where += " AND page_text MATCH ?"
+            args.append(" AND ".join(map(_fts_phrase, sorted(trigrams))))
+        where += ")"
+        return self._select_page_refs(where, args, query.limit_books)
+
+    def _select_page_refs(self, where, args, limit_books):
+        sql = PAGE_SELECT + " WHERE " + where
+        if limit_books:
+            sql += " AND b.name IN (" + ",".join("?" * len(limit_books)) + ")"
+            args = args + sorted(limit_books)
+        sql += " ORDER BY b.name, p.pos"
+        start = time.monotonic()
+        rows = self.conn.execute(sql, args).fetchall()
+        end = time.monotonic()
+        logging.info("sql store: %d rows in %.6f", len(rows), end - start)
+        return [IndexPageRef(doc_name, title) for doc_name, title in rows]
+
+    def resolve_page_ref(self, page_ref, sections=None):
+        """read a single page from the store.
+        if sections are given then only read these sections and no raw page"""
+        raw_column = "NULL" if sections else "p.raw_page"
+        row = self.conn.execute(
+            f"SELECT p.id, p.toc, {raw_column} FROM pages p"
+            " JOIN books b ON p.book_id = b.id WHERE b.name = ? AND p.title = ?",
+            (page_ref.get_doc_name(), page_ref.get_page_title()),
+        ).fetchone()
+        page_id, toc, raw_page = row
+        page = AutoDocPage(page_ref.get_page_title())
+        page.set_raw_page(raw_page)
+        sql = "SELECT name, lines FROM sections WHERE page_id = ?"
+        args = [page_id]
+        if sections:
+            sql += " AND name IN (" + ",".join("?" * len(sections)) + ")"
+            args += sections
+        page_sections = {}
+        for name, lines in self.conn.execute(sql, args):
+            page_sections[name] = lines.split("\n") if lines else []
+        for name in json.loads(toc):
+            if name in page_sections:
+                page.add_section(name, page_sections[name])
+        logging.info("sql store: resolved page: %s -> %s", page_ref, page)
+        return page
+
+    def resolve_page_refs(self, page_refs, sections=None):
+        return [self.resolve_page_ref(x, sections) for x in page_refs]
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import logging
+
+from .cachefile import load_json
+from .index import PageIndices
+from .pagestore import PAGES_DIR
+
+STATS_FILE = "_stats.jsonl"
+MAX_STATS_SIZE = 1024 * 1024
+
+
+def get_fold_case_files():
+    """return names of the index files keyed by lower case keys"""
+    indices = PageIndices()
+    indices.add_title_index()
+    indices.add_topic_title_index()
+    indices.add_see_also_index()
+    names = set()
+    for index in indices.get_indices():
+        if index.is_fold_case():
+            names.add(index.get_index_name(False))
+            names.add(index.get_index_name(True))
+    return names
+
+
+def percentile(values, p):
+    """nearest rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    pos = int(round(p / 100 * (len(values) - 1)))
+    return values[pos]
+
+
+class Stats:
+    """collect metrics of one invocation and append them to the stats file.
+
+    The stats file is rotated if it grows larger than MAX_STATS_SIZE. Only
+    the current and the previous file are kept.
+    """
+
+    def __init__(self, stats_dir):
+        self.stats_file = os.path.join(stats_dir, STATS_FILE)
+        self.start = time.monotonic()
+        self.data = {"time": time.time()}
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def add(self, key, value):
+        self.data[key] = self.data.get(key, 0) + value
+
+    def save(self):
+        self.data["latency"] = time.monotonic() - self.start
+        line = json.dumps(self.data) + "\n"
+        # rotate?
+        if (
+            os.path.exists(self.stats_file)
+            and os.path.getsize(self.stats_file) > MAX_STATS_SIZE
+        ):
+            os.replace(self.stats_file, self.stats_file + ".1")
+        # a single append of a short line is atomic
+        with open(self.stats_file, "a") as fh:
+            fh.write(line)
+        logging.info("stats: %s", self.data)
+
+
+def load_stats(stats_dir):
+    """return list of all recorded invocations"""
+    records = []
+    stats_file = os.path.join(stats_dir, STATS_FILE)
+    for path in (stats_file + ".1", stats_file):
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logging.warning("stats: skip invalid line in '%s'", path)
+    return records
+
+
+def _format_ratio(num, total):
+    if total == 0:
+        return "-"
+    return f"{num}/{total} ({100 * num / total:.1f}%)"
+
+
+def summarize_stats(cache_dir):
+    """return lines with a summary of all stats and the cache dir"""
+    records = load_stats(cache_dir)
+    lines = []
+
+    # invocations
+    num_cold = len(list(filter(lambda x: not x.get("clean", True), records)))
+    lines.append(f"invocations: {len(records)}")
+    lines.append(f"cache rebuilds: {_format_ratio(num_cold, len(records))}")
+
+    # latency per mode
+    lines.append("")
+    lines.append(
+        f"{'mode':16} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'cold/warm':>9}"
+    )
+    modes = {}
+    for record in records:
+        modes.setdefault(record.get("mode", "?"), []).append(record)
+    for mode in sorted(modes):
+        mode_records = modes[mode]
+        latencies = sorted(map(lambda x: x["latency"], mode_records))
+        cold = list(
+            map(
+                lambda x: x["latency"],
+                filter(lambda x: not x.get("clean", True), mode_records),
+            )
+        )
+        warm = list(
+            map(
+                lambda x: x["latency"],
+                filter(lambda x: x.get("clean", True), mode_records),
+            )
+        )
+        if cold and warm:
+            ratio = f"{(sum(cold) / len(cold)) / (sum(warm) / len(warm)):.1f}"
+        else:
+            ratio = "-"
+        lines.append(
+            f"{mode:16} {len(latencies):6} {percentile(latencies, 50):9.6f}"
+            f" {percentile(latencies, 90):9.6f} {percentile(latencies, 99):9.6f}"
+            f" {ratio:>9}"
+        )
+
+    # caches
+    lines.append("")
+    lookups = sum(map(lambda x: x.get("result_lookups", 0), records))
+    hits = sum(map(lambda x: x.get("result_hits", 0), records))
+    lines.append(f"result cache hits: {_format_ratio(hits, lookups)}")
+    book_hits = sum(map(lambda x: x.get("book_hits", 0), records))
+    book_misses = sum(map(lambda x: x.get("book_misses", 0), records))
+    book_evictions = sum(map(lambda x: x.get("book_evictions", 0), records))
+    lines.append(
+        f"book cache hits: {_format_ratio(book_hits, book_hits + book_misses)}"
+        f", evictions: {book_evictions}"
+    )
+
+    # cache files
+    lines.append("")
+    total = 0
+    fold_case_files = get_fold_case_files()
+    for file in sorted(os.listdir(cache_dir)):
+        path = os.path.join(cache_dir, file)
+        if not os.path.isfile(path) or file == "_lock":
+            continue
+        size = os.path.getsize(path)
+        total += size
+        info = ""
+        # key counts of indices
+        if file.startswith("_index_"):
+            index = load_json(path, file.endswith(".gz")).get("index", {})
+            # folded keys hold an entry per spelling
+            if file in fold_case_files:
+                num_keys = sum(map(len, index.values()))
+            else:
+                num_keys = len(index)
+            info = f" keys={num_keys}"
+        lines.append(f"{file:32} {size:10}{info}")
+    # packs of the page store
+    pages_dir = os.path.join(cache_dir, PAGES_DIR)
+    if os.path.isdir(pages_dir):
+        size = 0
+        num_packs = 0
+        for file in os.listdir(pages_dir):
+            size += os.path.getsize(os.path.join(pages_dir, file))
+            if not file.startswith("_"):
+                num_packs += 1
+        total += size
+        lines.append(f"{PAGES_DIR + '/':32} {size:10} packs={num_packs}")
+    lines.append(f"{'total':32} {total:10}")
+    return lines
@@ -0,0 +1,30 @@
+from aman.book import AutoDocPage
+from aman.index import IndexPageRef
+from aman.postings import BooleanQuery, PostingIndex
+
+
+def make_query(texts):
+    pages = {}
+    index = PostingIndex()
+    index._begin_rebuild()
+    for num, lines in enumerate(texts):
+        title = f"test.library/Func{num}"
+        page = AutoDocPage(title)
+        page.add_section("FUNCTION", lines)
+        pages[title] = page
+        index._add_page(IndexPageRef("test", title), index._get_page_keys(page))
+    index._end_rebuild()
+    return BooleanQuery(index, lambda page_ref: pages[page_ref.get_page_title()])
+
+
+def test_phrase_matches_whole_words():
+    query = make_query(
+        [["the message portable thing", "port"], ["a message port here"]]
+    )
+    assert list(query.search('"message port"')) == [1]
+
+
+def test_phrase_across_lines():
+    query = make_query([["a message", "port here"], ["message and port"]])
+    assert list(query.search('"message port"')) == [0]
+    assert list(query.search("message AND port")) == [0, 1]
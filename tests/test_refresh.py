@@ -0,0 +1,119 @@
+import os
+import zipfile
+
+import aman.refresh
+from aman import Config, Session
+
+PAGE = """\fexec.library/{name}
+
+   NAME
+\t{name} -- {func}
+
+   SYNOPSIS
+\t{name}(port)
+\t      A0
+
+   FUNCTION
+\t{func}
+
+   SEE ALSO
+\tGetMsg()
+"""
+
+
+def write_doc(doc_dir, funcs):
+    toc = "".join(f"exec.library/{name}\n" for name in funcs)
+    pages = "".join(PAGE.format(name=name, func=func) for name, func in funcs.items())
+    path = os.path.join(doc_dir, "exec.doc")
+    with open(path, "w") as fh:
+        fh.write("TABLE OF CONTENTS\n\n" + toc + pages + "\f")
+    return path
+
+
+def write_zip(zip_path, funcs, date_time):
+    doc_dir = os.path.dirname(zip_path)
+    path = write_doc(doc_dir, funcs)
+    with open(path) as fh:
+        text = fh.read()
+    os.remove(path)
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        zf.writestr(zipfile.ZipInfo("docs/exec.doc", date_time), text)
+
+
+def make_session(tmp_path, funcs, max_books):
+    doc_dir = tmp_path / "docs"
+    doc_dir.mkdir()
+    write_doc(str(doc_dir), funcs)
+    config = Config(use_env=False)
+    config.set_man_path([str(doc_dir)])
+    config.set_cache_dir(str(tmp_path / "cache"))
+    config.set_book_budget(max_books, 0)
+    return Session(config), str(doc_dir)
+
+
+def refresh_with(session, doc_dir, funcs):
+    session.start_refresh(interval=3600)
+    try:
+        path = write_doc(doc_dir, funcs)
+        # make sure the change is seen even on coarse file systems
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        assert session.refresher.check()
+    finally:
+        session.stop_refresh()
+
+
+def check_refresh(tmp_path, max_books):
+    funcs = {"GetMsg": "get a message", "PutMsg": "put a message"}
+    session, doc_dir = make_session(tmp_path, funcs, max_books)
+    assert session.get_page("exec.library/PutMsg")
+    assert session.search("CHANGED") == []
+    # only PutMsg changes. GetMsg is taken from the page store
+    funcs["PutMsg"] = "put a CHANGED message"
+    refresh_with(session, doc_dir, funcs)
+    page = session.get_page("exec.library/PutMsg")
+    assert "put a CHANGED message" in page.get_section("FUNCTION")
+    titles = [x.get_title() for x in session.search("CHANGED")]
+    assert titles == ["exec.library/PutMsg"]
+
+
+def test_refresh_without_book_budget(tmp_path):
+    check_refresh(tmp_path, 0)
+
+
+def test_refresh_with_book_budget(tmp_path):
+    check_refresh(tmp_path, 5)
+
+
+def test_refresh_skips_unchanged_archive(tmp_path, monkeypatch):
+    funcs = {"GetMsg": "get a message", "PutMsg": "put a message"}
+    zip_path = str(tmp_path / "docs.zip")
+    write_zip(zip_path, funcs, (2020, 1, 1, 0, 0, 0))
+    config = Config(use_env=False)
+    config.set_man_path([zip_path])
+    config.set_cache_dir(str(tmp_path / "cache"))
+    session = Session(config)
+    session.start_refresh(interval=3600)
+    try:
+        scans = []
+        scan_autodocs = aman.refresh.scan_autodocs
+
+        def counting_scan(man_path, doc_class):
+            scans.append(man_path)
+            return scan_autodocs(man_path, doc_class)
+
+        monkeypatch.setattr(aman.refresh, "scan_autodocs", counting_scan)
+        assert not session.refresher.check()
+        assert not session.refresher.check()
+        assert scans == [zip_path]
+        # a changed archive is scanned again
+        funcs["PutMsg"] = "put a CHANGED message"
+        write_zip(zip_path, funcs, (2021, 1, 1, 0, 0, 0))
+        st = os.stat(zip_path)
+        os.utime(zip_path, (st.st_atime, st.st_mtime + 10))
+        assert session.refresher.check()
+        assert scans == [zip_path, zip_path]
+    finally:
+        session.stop_refresh()
+    page = session.get_page("exec.library/PutMsg")
+    assert "put a CHANGED message" in page.get_section("FUNCTION")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""startup benchmark of a warm 'aman KEYWORD' lookup.
+
+Runs the lookup with 'python -X importtime' on a tiny autodoc and reports
+the import time of the fastest run. Fails if the import time exceeds the
+threshold or if a module of another mode is imported by the lookup.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_MAX_MS = 40.0
+DEFAULT_RUNS = 10
+
+# modules that a plain lookup must not import
+LAZY_MODULES = (
+    "argparse",
+    "concurrent.futures",
+    "hashlib",
+    "html",
+    "sqlite3",
+    "subprocess",
+    "tarfile",
+    "tempfile",
+    "termcolor",
+    "zipfile",
+    "aman.export",
+    "aman.lsp",
+    "aman.postings",
+    "aman.proto",
+    "aman.related",
+    "aman.sqlstore",
+)
+
+AUTODOC = """TABLE OF CONTENTS
+
+bench.library/BenchFunc
+\fbench.library/BenchFunc
+
+   NAME
+\tBenchFunc -- a function to benchmark
+
+   SYNOPSIS
+\tresult = BenchFunc(arg)
+\tD0               D1
+
+\tLONG BenchFunc(LONG);
+
+   SEE ALSO
+\tBenchFunc()
+\f"""
+
+
+def run_lookup(env, keyword):
+    """run lookup and return dict of module -> cumulative import time in us"""
+    cmd = [sys.executable, "-X", "importtime", "-m", "aman", keyword]
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # indent of the name gives the nesting level
+        depth = len(name) - len(name.lstrip())
+        modules[name.strip()] = (int(cumulative), depth)
+    return modules
+
+
+def get_total_ms(modules):
+    min_depth = min(depth for _, depth in modules.values())
+    total = sum(us for us, depth in modules.values() if depth == min_depth)
+    return total / 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=DEFAULT_MAX_MS,
+        help="fail if import time is above this (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=DEFAULT_RUNS,
+        help="number of lookups (default: %(default)s)",
+    )
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        doc_dir = os.path.join(tmp_dir, "docs")
+        os.makedirs(doc_dir)
+        with open(os.path.join(doc_dir, "bench.doc"), "w") as fh:
+            fh.write(AUTODOC)
+        env = {
+            "PATH": os.environ.get("PATH", ""),
+            "HOME": tmp_dir,
+            "AMANPATH": doc_dir,
+            "AMANCACHE": os.path.join(tmp_dir, "cache"),
+        }
+        src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = src_dir
+
+        # first run builds the caches
+        run_lookup(env, "BenchFunc")
+        best = None
+        for _ in range(opts.runs):
+            modules = run_lookup(env, "BenchFunc")
+            total = get_total_ms(modules)
+            if best is None or total < best[0]:
+                best = (total, modules)
+
+    total, modules = best
+    print(f"import time of plain lookup: {total:.1f} ms (max {opts.max_ms} ms)")
+    ok = True
+    for name in LAZY_MODULES:
+        if name in modules:
+            print(f"error: plain lookup imports '{name}'")
+            ok = False
+    if total > opts.max_ms:
+        print("error: import time is above threshold")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())